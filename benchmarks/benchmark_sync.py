@@ -0,0 +1,393 @@
+"""
+End-to-end benchmark for sync_to_trakt.py.
+
+Starts a local HTTP stand-in for the Trakt, MAL and AniList APIs, points the real sync at it and runs it
+over synthetic anime lists. Each run reports wall time, requests per endpoint, HTTP body bytes transferred
+and time spent sleeping (rate limiting and 429 retries). Results are written as JSON so runs can be compared
+across changes.
+
+Usage (from the repository root):
+    python benchmarks/benchmark_sync.py                              # 100, 1000 and 10000 entries, MAL and AniList
+    python benchmarks/benchmark_sync.py --sizes 1000 --sources MAL --latency-ms 80 --rate-limit-every 25
+    python benchmarks/benchmark_sync.py --output before.json         # compare with a later --output after.json
+
+Every size/source pair runs two scenarios: 'cold' (empty caches, full sync) and 'warm' (an immediate
+incremental rerun with the caches from the cold run).
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import sync_to_trakt as sync # noqa: E402
+
+
+# --- Mock API Server ---
+
+class MockApiState:
+    """Synthetic lists, Trakt library and request statistics shared by the mock server threads."""
+    def __init__(self, size, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.request_counts = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.injected_429 = 0
+        self.host_counters = collections.Counter()
+        self.history = {"shows": set(), "movies": set()}
+        self.watched_episodes = set() # Episode Trakt IDs added to history one by one
+        self.ratings = {"shows": set(), "movies": set()}
+        self.mal_entries, self.anilist_entries = make_synthetic_lists(size)
+
+    def reset_stats(self):
+        with self.lock:
+            self.request_counts.clear()
+            self.bytes_in = self.bytes_out = self.injected_429 = 0
+
+
+# Every synthetic show has a special and two seasons of EPISODES_PER_SEASON episodes on Trakt
+EPISODES_PER_SEASON = 6
+
+
+def make_synthetic_lists(size):
+    """
+    Builds MAL and AniList list entries for the same `size` synthetic anime (newest update first).
+    Watching entries have 1 to 11 of their 12 episodes watched.
+    """
+    statuses = ["completed"] * 7 + ["watching"] * 2 + ["plan_to_watch"]
+    base_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    mal_entries, anilist_entries = [], []
+    for i in range(size):
+        status = statuses[i % len(statuses)]
+        media_type = "movie" if i % 7 == 0 else "tv"
+        updated_at = base_time + (size - i) * 60
+        title = f"Benchmark Show {i}"
+        score = i % 11
+        finish_date = f"20{10 + i % 14}-0{1 + i % 9}-1{i % 10}"
+        episodes = 1 if media_type == "movie" else 2 * EPISODES_PER_SEASON
+        watched = episodes if status == "completed" else 0 if status == "plan_to_watch" else 1 + i % (episodes - 1 or 1)
+        mal_entries.append({
+            "node": {"id": 100000 + i, "title": title, "alternative_titles": {"en": title},
+                     "media_type": media_type, "start_date": f"{2000 + i % 20}-04-01", "num_episodes": episodes},
+            "list_status": {"status": status, "score": score, "num_episodes_watched": watched, "finish_date": finish_date,
+                            "updated_at": datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc).isoformat()},
+        })
+        if status == "plan_to_watch": continue # The AniList query only asks for COMPLETED and CURRENT
+        year, month, day = map(int, finish_date.split("-"))
+        anilist_entries.append({
+            "status": "COMPLETED" if status == "completed" else "CURRENT", "score": score * 10, "progress": watched,
+            "completedAt": {"year": year, "month": month, "day": day}, "updatedAt": int(updated_at),
+            "media": {"id": 100000 + i, "title": {"romaji": title, "english": title},
+                      "format": "MOVIE" if media_type == "movie" else "TV", "type": "ANIME", "episodes": episodes,
+                      "startDate": {"year": 2000 + i % 20}},
+        })
+    return mal_entries, anilist_entries
+
+
+def _endpoint_name(method, path):
+    """Groups request paths into endpoints, e.g. 'GET /trakt/search/show'."""
+    path = re.sub(r"^/mal/users/[^/]+/", "/mal/users/:user/", path)
+    path = re.sub(r"/(tvdb|tmdb|imdb)/[^/]+$", r"/\1/:id", path)
+    path = re.sub(r"^/trakt/shows/\d+/", "/trakt/shows/:id/", path)
+    return f"{method} {path}"
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so connection pooling is exercised
+
+    def log_message(self, *args): pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items(): self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.state.lock: self.state.bytes_out += len(body)
+
+    def _begin(self, method):
+        """Reads the request, records it, applies latency. Returns (path, query, body) or None if answered with 429."""
+        url = urlparse(self.path)
+        raw_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        host = url.path.split("/")[1]
+        options = self.state.options
+        with self.state.lock:
+            self.state.bytes_in += len(raw_body)
+            self.state.request_counts[_endpoint_name(method, url.path)] += 1
+            self.state.host_counters[host] += 1
+            inject_429 = options.rate_limit_every and self.state.host_counters[host] % options.rate_limit_every == 0
+            if inject_429: self.state.injected_429 += 1
+        latency = options.latency_ms + random.uniform(0, options.latency_jitter_ms)
+        if latency > 0: threading.Event().wait(latency / 1000.0) # Not time.sleep: that is counted as client sleep
+        if inject_429:
+            self._send(429, {}, {"Retry-After": str(options.retry_after)})
+            return None
+        return url.path, parse_qs(url.query), json.loads(raw_body) if raw_body else {}
+
+    def do_GET(self):
+        request = self._begin("GET")
+        if request is None: return
+        path, query, _body = request
+        if path.startswith("/mal/users/"): return self._mal_list(query)
+        if path == "/trakt/sync/last_activities": return self._trakt_last_activities()
+        match = re.match(r"^/trakt/sync/(watched|ratings)/(shows|movies)$", path)
+        if match: return self._trakt_sync_list(match.group(1), match.group(2), query)
+        match = re.match(r"^/trakt/search/(tvdb|tmdb|imdb)/(\w+)$", path)
+        if match: return self._send(200, [])
+        match = re.match(r"^/trakt/search/([a-z,]+)$", path)
+        if match: return self._trakt_search(match.group(1), query)
+        match = re.match(r"^/trakt/shows/(\d+)/seasons$", path)
+        if match: return self._trakt_show_seasons(int(match.group(1)))
+        match = re.match(r"^/trakt/shows/(\d+)/progress/watched$", path)
+        if match: return self._trakt_show_progress(int(match.group(1)))
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        request = self._begin("POST")
+        if request is None: return
+        path, _query, body = request
+        if path == "/anilist": return self._anilist(body)
+        if path in ("/trakt/sync/history", "/trakt/sync/ratings"):
+            library = self.state.history if path.endswith("history") else self.state.ratings
+            added = {}
+            with self.state.lock:
+                for kind in ("shows", "movies"):
+                    items = body.get(kind, [])
+                    library[kind].update(item["ids"]["trakt"] for item in items)
+                    added[kind] = len(items)
+                episode_ids = [item["ids"]["trakt"] for item in body.get("episodes", [])]
+                self.state.watched_episodes.update(episode_ids)
+                library["shows"].update(episode_id // 100 for episode_id in episode_ids) # Partly watched shows are listed too
+            if path.endswith("history"):
+                added = {"movies": added["movies"], "episodes": 2 * EPISODES_PER_SEASON * added["shows"] + len(episode_ids)}
+            return self._send(201, {"added": added, "not_found": {"shows": [], "movies": []}})
+        self._send(404, {"error": "not found"})
+
+    def _mal_list(self, query):
+        entries = self.state.mal_entries
+        if "status" in query: entries = [e for e in entries if e["list_status"]["status"] == query["status"][0]]
+        limit = min(int(query.get("limit", ["100"])[0]), self.state.options.mal_page_cap)
+        offset = int(query.get("offset", ["0"])[0])
+        paging = {}
+        if offset + limit < len(entries):
+            next_query = {k: v[0] for k, v in query.items()}
+            next_query.update(offset=str(offset + limit), limit=str(limit))
+            base = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}{urlparse(self.path).path}"
+            paging["next"] = base + "?" + "&".join(f"{k}={v}" for k, v in next_query.items())
+        self._send(200, {"data": entries[offset:offset + limit], "paging": paging})
+
+    def _anilist(self, body):
+        query, variables = body.get("query", ""), body.get("variables", {})
+        entries = self.state.anilist_entries
+        if "MediaListCollection" in query:
+            per_chunk = variables.get("perChunk") or len(entries)
+            chunk = variables.get("chunk") or 1
+            part = entries[(chunk - 1) * per_chunk:chunk * per_chunk]
+            lists = [{"isCustomList": False, "entries": [e for e in part if e["status"] == status]}
+                     for status in ("COMPLETED", "CURRENT")]
+            return self._send(200, {"data": {"MediaListCollection": {"hasNextChunk": chunk * per_chunk < len(entries), "lists": lists}}})
+        page, per_page = variables.get("page", 1), variables.get("perPage", 50)
+        page_entries = entries[(page - 1) * per_page:page * per_page]
+        self._send(200, {"data": {"Page": {"pageInfo": {"hasNextPage": page * per_page < len(entries)}, "mediaList": page_entries}}})
+
+    def _trakt_search(self, types, query):
+        number = re.search(r"(\d+)", query.get("query", [""])[0])
+        if not number or int(number.group(1)) % 50 == 49: return self._send(200, []) # Some titles are not on Trakt
+        i = int(number.group(1))
+        item_type = "movie" if i % 7 == 0 else "show"
+        if item_type not in types.split(","): return self._send(200, [])
+        item = {"title": f"Benchmark Show {i}", "year": 2000 + i % 20, "ids": {"trakt": 500000 + i, "slug": f"benchmark-show-{i}"}}
+        self._send(200, [{"type": item_type, "score": 100, item_type: item}])
+
+    def _trakt_show_seasons(self, trakt_id):
+        """Season 0 with one special, then seasons 1 and 2. Episode Trakt IDs are trakt_id * 100 + season * 20 + number."""
+        if self.headers.get("If-None-Match") == f'"{trakt_id}"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        seasons = [{"number": season, "episodes": [{"number": number, "ids": {"trakt": trakt_id * 100 + season * 20 + number}}
+                                                   for number in range(1, (EPISODES_PER_SEASON if season else 1) + 1)]}
+                   for season in range(3)]
+        self._send(200, seasons, {"ETag": f'"{trakt_id}"'})
+
+    def _trakt_show_progress(self, trakt_id):
+        with self.state.lock: watched = set(self.state.watched_episodes)
+        self._send(200, {"seasons": [{"number": season, "episodes": [{"number": number, "completed": trakt_id * 100 + season * 20 + number in watched}
+                                                                   for number in range(1, EPISODES_PER_SEASON + 1)]}
+                                     for season in (1, 2)]})
+
+    def _trakt_sync_list(self, kind, item_kind, query):
+        library = self.state.history if kind == "watched" else self.state.ratings
+        with self.state.lock: ids = sorted(library[item_kind])
+        limit = min(int(query.get("limit", ["10"])[0]), self.state.options.trakt_page_cap)
+        page = int(query.get("page", ["1"])[0])
+        page_count = max(1, -(-len(ids) // limit))
+        item_type = item_kind[:-1]
+        items = [{item_type: {"ids": {"trakt": trakt_id}}, "rating": 8} for trakt_id in ids[(page - 1) * limit:page * limit]]
+        self._send(200, items, {"X-Pagination-Page-Count": str(page_count)})
+
+    def _trakt_last_activities(self):
+        with self.state.lock:
+            counts = {name: len(ids) for name, ids in (("history", self.state.history["shows"] | self.state.history["movies"]),
+                                                       ("ratings", self.state.ratings["shows"] | self.state.ratings["movies"]))}
+        stamp = lambda n: datetime.datetime.fromtimestamp(1700000000 + n, datetime.timezone.utc).isoformat().replace("+00:00", ".000Z")
+        self._send(200, {"all": stamp(counts["history"] + counts["ratings"]),
+                         "episodes": {"watched_at": stamp(counts["history"])}, "movies": {"watched_at": stamp(counts["history"]), "rated_at": stamp(counts["ratings"])},
+                         "shows": {"rated_at": stamp(counts["ratings"])}, "seasons": {"rated_at": stamp(counts["ratings"])}})
+
+
+def start_mock_server(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockApiHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- Benchmark Runner ---
+
+class SleepMeter:
+    """Replaces time.sleep while a run is measured and sums the seconds slept across all client threads."""
+    def __init__(self):
+        self.total = 0.0
+        self.lock = threading.Lock()
+        self._original_sleep = time.sleep
+
+    def _sleep(self, seconds):
+        with self.lock: self.total += max(0.0, seconds)
+        self._original_sleep(seconds)
+
+    def __enter__(self):
+        time.sleep = self._sleep
+        return self
+
+    def __exit__(self, *exc):
+        time.sleep = self._original_sleep
+
+
+def configure_sync_module(base_url, work_dir, options):
+    """Points the sync module at the mock server and a scratch directory."""
+    sync.TRAKT_API_URL = f"{base_url}/trakt"
+    sync.MAL_API_URL = f"{base_url}/mal"
+    sync.ANILIST_API_URL = f"{base_url}/anilist"
+    sync.TRAKT_TOKEN_FILE = os.path.join(work_dir, "trakt_tokens.json")
+    sync.ID_MAPPING_FILE = None
+    sync.ID_MAPPING_URL = None
+    sync.INCREMENTAL_SYNC = True
+    sync._TRAKT_LIBRARY_IN_MEMORY.clear()
+    with open(sync.TRAKT_TOKEN_FILE, "w") as f:
+        json.dump({"access_token": "benchmark", "refresh_token": "benchmark", "expires_in": 10 ** 8, "acquired_at": time.time()}, f)
+    for limiter in (sync.TRAKT_GET_LIMITER, sync.TRAKT_POST_LIMITER, sync.ANILIST_LIMITER, sync.MAL_LIMITER):
+        limiter.blocked_until = 0.0
+        if not options.real_rate_limits:
+            limiter.bucket = sync.TokenBucket(10 ** 9, 1) # Measure the sync itself, not the configured budgets
+        else:
+            limiter.bucket = sync.TokenBucket(limiter.bucket.fill_rate, 1, limiter.bucket.capacity)
+
+
+def run_scenario(state, source, full):
+    """Runs one sync against the mock server. Returns the measurements."""
+    state.reset_stats()
+    account = {"name": "benchmark", "data_source": source, "username": "benchmark", "mal_client_id": "benchmark",
+               "token_file": sync.TRAKT_TOKEN_FILE,
+               "library_cache_file": os.path.join(os.path.dirname(sync.TRAKT_TOKEN_FILE), "trakt_library_cache.json"),
+               "journal_file": os.path.join(os.path.dirname(sync.TRAKT_TOKEN_FILE), "sync_journal.jsonl")}
+    args = argparse.Namespace(full=full, daemon=False, resume=False)
+    output = io.StringIO()
+    with SleepMeter() as sleep_meter, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        started = time.perf_counter()
+        exit_code = sync.run_sync(args, account)
+        wall_time = time.perf_counter() - started
+    with state.lock:
+        return {
+            "exit_code": exit_code,
+            "wall_time_s": round(wall_time, 3),
+            "sleep_time_s": round(sleep_meter.total, 3),
+            "requests_total": sum(state.request_counts.values()),
+            "requests_by_endpoint": dict(sorted(state.request_counts.items())),
+            "bytes_sent": state.bytes_in,
+            "bytes_received": state.bytes_out,
+            "injected_429": state.injected_429,
+        }
+
+
+def run_benchmarks(options):
+    results = []
+    for size in options.sizes:
+        for source in options.sources:
+            state = MockApiState(size, options)
+            server = start_mock_server(state)
+            base_url = f"http://127.0.0.1:{server.server_address[1]}"
+            with tempfile.TemporaryDirectory(prefix="sync-benchmark-") as work_dir:
+                configure_sync_module(base_url, work_dir, options)
+                for scenario, full in (("cold", True), ("warm", False)):
+                    measured = run_scenario(state, source, full)
+                    results.append({"source": source, "entries": size, "scenario": scenario, **measured})
+                    print(f"{source:8} {size:>6} entries  {scenario:5}  {measured['wall_time_s']:>8.2f}s  "
+                          f"{measured['requests_total']:>6} requests  {measured['bytes_received'] / 1024:>9.1f} KiB in  "
+                          f"slept {measured['sleep_time_s']:.2f}s  exit {measured['exit_code']}")
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync_to_trakt.py against local mock Trakt/MAL/AniList servers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Synthetic list sizes (entries).")
+    parser.add_argument("--sources", nargs="+", choices=["MAL", "AniList"], default=["MAL", "AniList"])
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Added latency per request.")
+    parser.add_argument("--latency-jitter-ms", type=float, default=10.0, help="Random extra latency per request (0..N ms).")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request per host with HTTP 429 (0 = never).")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429 responses.")
+    parser.add_argument("--mal-page-cap", type=int, default=1000, help="Max entries per MAL list page, whatever limit is requested.")
+    parser.add_argument("--trakt-page-cap", type=int, default=1000, help="Max items per Trakt sync list page.")
+    parser.add_argument("--real-rate-limits", action="store_true", help="Keep the script's configured request budgets (slow for large lists).")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to.")
+    options = parser.parse_args()
+
+    results = run_benchmarks(options)
+    report = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "settings": {key: value for key, value in vars(options).items() if key != "output"},
+        "sync_settings": {"SEARCH_WORKERS": sync.SEARCH_WORKERS, "BATCH_SIZE": sync.BATCH_SIZE,
+                          "MAL_FETCH_MODE": sync.MAL_FETCH_MODE, "ANILIST_FETCH_MODE": sync.ANILIST_FETCH_MODE},
+        "results": results,
+    }
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
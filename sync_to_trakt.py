@@ -6,6 +6,21 @@ import datetime
 import os
 import math
 import unicodedata # Needed for title normalization
+import difflib # Ranking Trakt search candidates by title similarity
+import sqlite3 # Local Trakt match cache
+import argparse
+import threading
+import queue
+import itertools
+import collections
+import random # Daemon cycle jitter
+import re
+import zlib # Compressed bodies in the HTTP response cache
+import hashlib
+import bisect # Lookups in the indexed Trakt library
+from array import array
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, Future
 from tqdm import tqdm
 
 # --- Configuration ---
@@ -24,13 +39,51 @@ DATA_SOURCE = "MAL" # Choose 'MAL' for MyAnimeList or 'AniList'
 #      (Choose 'other' app type, Redirect URI isn't strictly needed but you might need to enter one like http://localhost)
 MAL_CLIENT_ID = "MAL_CLIENT_ID" # Paste your MAL Client ID here
 MAL_USERNAME = "MAL_USERNAME" # Paste the MAL Username whose list you want to sync
+MAL_FETCH_MODE = "single" # 'single' (one pass over the whole list, filtered locally) or 'status' (completed and watching lists fetched separately)
 
 # ---> If DATA_SOURCE is 'AniList':
 ANILIST_USERNAME = "ANILIST_USERNAME" # Paste the AniList Username whose list you want to sync
+ANILIST_FETCH_MODE = "collection" # 'collection' (whole list per MediaListCollection query) or 'pages' (50 entries per request)
 # --------------------------------------------------------------------------
 
 # File to store Trakt tokens (will be created automatically)
 TRAKT_TOKEN_FILE = "trakt_tokens.json"
+# SQLite file caching source ID -> Trakt ID matches (None = 'trakt_match_cache.sqlite3' next to TRAKT_TOKEN_FILE)
+TRAKT_MATCH_CACHE_FILE = None
+# Days before a cached match is re-validated with a fresh Trakt search (manual overrides never expire)
+MATCH_CACHE_TTL_DAYS = 30
+# Entries not found on Trakt are searched again after these many days (1st, 2nd, 3rd and later misses)
+MATCH_MISS_RETRY_DAYS = (1, 7, 30)
+# Group sequel seasons into franchises via AniList relations: one Trakt lookup per franchise,
+# and history is sent per season instead of marking the whole show as watched
+FRANCHISE_SEASONS = False
+# Sync CURRENT/watching entries as partial history: the first N watched episodes (list progress)
+SYNC_WATCHING_PROGRESS = True
+# Re-rate items whose source score differs from their current Trakt rating (False = never change existing Trakt ratings)
+UPDATE_CHANGED_RATINGS = False
+# JSON file with state kept between runs, e.g. source list watermarks (None = 'sync_state.json' next to TRAKT_TOKEN_FILE)
+SYNC_STATE_FILE = None
+# Only fetch source entries updated since the last successful run (use --full to fetch everything once)
+INCREMENTAL_SYNC = True
+# Optional: offline MAL/AniList -> TVDB/TMDB/IMDb ID mapping in Fribb/anime-lists format ('anime-list-full.json').
+# Entries found in it are resolved on Trakt by exact ID instead of title search.
+ID_MAPPING_FILE = None # Path to a local copy (None = 'anime-list-full.json' next to TRAKT_TOKEN_FILE when ID_MAPPING_URL is set)
+ID_MAPPING_URL = None # e.g. "https://raw.githubusercontent.com/Fribb/anime-lists/master/anime-list-full.json"
+ID_MAPPING_REFRESH_DAYS = 7 # Re-download from ID_MAPPING_URL when the local copy is older than this
+# JSON cache of your Trakt watched/rated IDs (None = 'trakt_library_cache.json' next to TRAKT_TOKEN_FILE)
+TRAKT_LIBRARY_CACHE_FILE = None
+# Days after which the cached Trakt library is fully re-downloaded, even if Trakt reports no new activity
+TRAKT_LIBRARY_MAX_AGE_DAYS = 7
+# SQLite cache of GET responses revalidated with ETag/Last-Modified (None = 'http_cache.sqlite3' next to TRAKT_TOKEN_FILE)
+HTTP_CACHE_FILE = None
+HTTP_CACHE_MAX_MB = 50 # Least recently used responses are evicted above this size (compressed); 0 disables the cache
+# Metrics (request latency/status per endpoint, 429 retries, sleeps) written after every run:
+# 'prometheus' (node_exporter textfile format), 'json', or None to disable
+METRICS_FORMAT = "prometheus"
+METRICS_FILE = None # None = 'sync_metrics.prom' / 'sync_metrics.json' next to TRAKT_TOKEN_FILE
+# Optional: JSON file listing several accounts to sync in one run (None = the single account configured above).
+# Each account has its own Trakt token file and write budget; the match cache and ID mapping are shared.
+ACCOUNTS_FILE = None
 
 # --- Constants ---
 ANILIST_API_URL = "https://graphql.anilist.co"
@@ -41,16 +94,520 @@ TRAKT_HEADERS = {
     "trakt-api-version": "2",
     "trakt-api-key": TRAKT_CLIENT_ID,
 }
-# Number of items to send to Trakt in one batch
+# Number of items to send to Trakt in one batch (starting size; adapted to Trakt's response times)
 BATCH_SIZE = 50
-# Delay between Trakt API calls (seconds)
-API_CALL_DELAY = 1.5
-# Delay between Source API calls (seconds) - Increase if rate limited
-# MAL Rate Limit is stricter (~60/min), AniList is generally more lenient
-SOURCE_API_DELAY = 1.2 if DATA_SOURCE == "MAL" else 0.8
+# Batch size bounds: grows while batches are answered within TRAKT_BATCH_TARGET_SECONDS and stay under
+# TRAKT_BATCH_MAX_BYTES, halves after a slow response, a too large payload, HTTP 429 or a failed batch
+TRAKT_BATCH_MIN_SIZE = 10
+TRAKT_BATCH_MAX_SIZE = 500
+TRAKT_BATCH_TARGET_SECONDS = 3.0
+TRAKT_BATCH_MAX_BYTES = 512 * 1024
+# Batch items waiting for the Trakt writer before the search stage pauses
+WRITE_QUEUE_SIZE = 1000
+# Number of concurrent Trakt title searches
+SEARCH_WORKERS = 4
+# Accounts synced at the same time when ACCOUNTS_FILE is set
+ACCOUNT_WORKERS = 2
+# Daemon mode (--daemon): minutes between sync cycles (--interval overrides) and random extra delay per cycle
+DAEMON_INTERVAL_MINUTES = 60
+DAEMON_JITTER_SECONDS = 300
+# Source pages fetched ahead of the Trakt search stage (bounded queue between the two)
+SOURCE_QUEUE_PAGES = 2
+# Max entries waiting on Trakt search results before source processing pauses
+SEARCH_QUEUE_SIZE = 200
+# Candidates requested per Trakt title search (ranked locally by title similarity, year and type)
+TRAKT_SEARCH_LIMIT = 10
+# Unmatched titles listed in the run summary (the rest are only counted)
+UNMATCHED_TITLES_SHOWN = 100
+# Lowest title similarity (0-1) a search candidate needs before its position, year and type count at all
+TRAKT_MATCH_MIN_SIMILARITY = 0.6
+# Lowest ranking score a search candidate needs to be accepted as the match (see _score_search_candidate)
+TRAKT_MATCH_MIN_SCORE = 0.5
+# Request budgets per host (requests per period in seconds). Requests are only delayed when the budget
+# runs low; whenever a server reports its real budget in response headers, that takes precedence.
+# Trakt: 1000 authenticated GETs per 5 minutes, 1 POST per second
+TRAKT_GET_RATE_LIMIT = 1000
+TRAKT_GET_RATE_PERIOD = 300
+TRAKT_POST_RATE_LIMIT = 1
+TRAKT_POST_RATE_PERIOD = 1
+# AniList: 90 requests per minute (sends X-RateLimit-* headers)
+ANILIST_RATE_LIMIT = 90
+ANILIST_RATE_PERIOD = 60
+# MAL: undocumented (~60/min) and sends no rate limit headers - decrease if you get HTTP 429
+MAL_RATE_LIMIT = 60
+MAL_RATE_PERIOD = 60
+# Entries per MediaListCollection chunk (AniList max 500); larger lists are fetched in several chunks
+ANILIST_COLLECTION_CHUNK_SIZE = 500
+# AniList media looked up per relations request, days relations stay cached, and max prequel steps followed
+ANILIST_RELATIONS_BATCH_SIZE = 50
+RELATIONS_CACHE_TTL_DAYS = 30
+FRANCHISE_MAX_DEPTH = 10
+# Days a show's cached season/episode layout is used before it is revalidated (ETag) with Trakt
+SHOW_SEASONS_CACHE_DAYS = 7
+# Items per page when reading your Trakt watched/ratings lists
+TRAKT_SYNC_PAGE_LIMIT = 1000
+# Wait used on HTTP 429 when the server doesn't send Retry-After (seconds)
+DEFAULT_RETRY_AFTER = 15
+# Upper bounds (seconds) of the request latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# GET endpoints kept in the HTTP response cache: (URL path pattern, seconds a stored response is used without
+# asking the server). Older responses are revalidated with If-None-Match/If-Modified-Since; a 304 serves the stored body.
+HTTP_CACHE_POLICIES = [
+    (r"/search/", 86400), # Trakt title and ID searches
+    (r"/sync/(watched|ratings)/", 0), # Trakt library (only re-downloaded on new Trakt activity anyway)
+    (r"/users/[^/]+/animelist", 0), # MAL list pages
+]
 
 # --- Helper Functions ---
 
+def _state_file_path(configured_path, default_name):
+    """Returns the configured path, or a file named default_name next to TRAKT_TOKEN_FILE."""
+    if configured_path: return configured_path
+    return os.path.join(os.path.dirname(TRAKT_TOKEN_FILE), default_name)
+
+# --- Metrics ---
+class SyncMetrics:
+    """
+    Thread-safe counters for every API call (latency histogram and status codes per endpoint), 429 retries,
+    deliberate sleeps and per-account run statistics. Counters are cumulative for the life of the process,
+    so daemon cycles keep adding to them, as Prometheus counters expect.
+    """
+    def __init__(self, latency_buckets):
+        self.lock = threading.Lock()
+        self.latency_buckets = tuple(latency_buckets)
+        self.latency = {} # (host, method, endpoint) -> {"buckets": [..], "count": n, "sum": seconds}
+        self.responses = collections.Counter() # (host, method, endpoint, status)
+        self.retries = collections.Counter() # (host, method, endpoint)
+        self.sleep_seconds = collections.Counter() # (host, reason)
+        self.sleeps = collections.Counter() # (host, reason)
+        self.accounts = {} # account -> summary counters of its last run
+        self.last_run = {}
+
+    @staticmethod
+    def endpoint(url):
+        """Reduces a URL to an endpoint label, e.g. '/users/:user/animelist' or '/search/tvdb/:id'."""
+        path = urlsplit(url).path or "/"
+        path = re.sub(r"/users/[^/]+", "/users/:user", path)
+        return re.sub(r"/(\d+|tt\d+)(?=/|$)", "/:id", path)
+
+    def record_request(self, host, method, url, status, seconds):
+        """Counts one response; seconds=None (served from the HTTP cache) leaves the latency histogram alone."""
+        key = (host, method, self.endpoint(url))
+        with self.lock:
+            self.responses[key + (str(status),)] += 1
+            if seconds is None: return
+            histogram = self.latency.setdefault(key, {"buckets": [0] * len(self.latency_buckets), "count": 0, "sum": 0.0})
+            for i, upper_bound in enumerate(self.latency_buckets):
+                if seconds <= upper_bound: histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+
+    def record_retry(self, host, method, url):
+        with self.lock: self.retries[(host, method, self.endpoint(url))] += 1
+
+    def record_sleep(self, host, reason, seconds):
+        if seconds <= 0: return
+        with self.lock:
+            self.sleep_seconds[(host, reason)] += seconds
+            self.sleeps[(host, reason)] += 1
+
+    def record_account_run(self, account_name, stats):
+        with self.lock: self.accounts[account_name] = {"timestamp": time.time(), **stats}
+
+    def record_run(self, started_at, duration, exit_code):
+        with self.lock: self.last_run = {"timestamp": started_at, "duration_seconds": duration, "exit_code": exit_code}
+
+    def to_json(self):
+        with self.lock:
+            no_latency = {"buckets": [0] * len(self.latency_buckets), "count": 0, "sum": 0.0} # Endpoints only served from cache
+            endpoints = sorted(set(self.latency) | {key[:3] for key in self.responses})
+            return json.dumps({
+                "last_run": self.last_run,
+                "accounts": self.accounts,
+                "requests": [{"host": h, "method": m, "endpoint": e, "count": v["count"], "latency_sum_seconds": round(v["sum"], 6),
+                              "latency_buckets": dict(zip(map(str, self.latency_buckets), v["buckets"])),
+                              "status_codes": {s: n for (h2, m2, e2, s), n in self.responses.items() if (h2, m2, e2) == (h, m, e)},
+                              "retries": self.retries.get((h, m, e), 0)}
+                             for (h, m, e), v in ((key, self.latency.get(key, no_latency)) for key in endpoints)],
+                "sleeps": [{"host": h, "reason": r, "count": self.sleeps[(h, r)], "seconds": round(seconds, 3)}
+                           for (h, r), seconds in sorted(self.sleep_seconds.items())],
+            }, indent=2)
+
+    def to_prometheus(self):
+        def labels(**values):
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values.values())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in zip(values, escaped)) + "}"
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"])
+            lines.extend(f"{sample_name}{sample_labels} {value}" for sample_name, sample_labels, value in samples)
+        with self.lock:
+            samples = []
+            for (host, method, endpoint), histogram in sorted(self.latency.items()):
+                for upper_bound, count in zip(self.latency_buckets, histogram["buckets"]):
+                    samples.append(("sync_http_request_duration_seconds_bucket", labels(host=host, method=method, endpoint=endpoint, le=upper_bound), count))
+                samples.append(("sync_http_request_duration_seconds_bucket", labels(host=host, method=method, endpoint=endpoint, le="+Inf"), histogram["count"]))
+                samples.append(("sync_http_request_duration_seconds_sum", labels(host=host, method=method, endpoint=endpoint), float(histogram["sum"])))
+                samples.append(("sync_http_request_duration_seconds_count", labels(host=host, method=method, endpoint=endpoint), histogram["count"]))
+            metric("sync_http_request_duration_seconds", "histogram", "API request latency per endpoint.", samples)
+            metric("sync_http_responses_total", "counter", "API responses per endpoint and status code ('error' = no response, 'cached' = served from the HTTP cache).",
+                   [("sync_http_responses_total", labels(host=h, method=m, endpoint=e, status=s), n) for (h, m, e, s), n in sorted(self.responses.items())])
+            metric("sync_http_retries_total", "counter", "Requests retried after HTTP 429.",
+                   [("sync_http_retries_total", labels(host=h, method=m, endpoint=e), n) for (h, m, e), n in sorted(self.retries.items())])
+            metric("sync_sleep_seconds_total", "counter", "Seconds spent sleeping, by host and reason.",
+                   [("sync_sleep_seconds_total", labels(host=h, reason=r), float(v)) for (h, r), v in sorted(self.sleep_seconds.items())])
+            metric("sync_sleeps_total", "counter", "Number of sleeps, by host and reason.",
+                   [("sync_sleeps_total", labels(host=h, reason=r), n) for (h, r), n in sorted(self.sleeps.items())])
+            account_samples = []
+            for account_name, stats in sorted(self.accounts.items()):
+                account_samples.extend(("sync_account_last_run_entries", labels(account=account_name, stat=stat), value)
+                                       for stat, value in sorted(stats.items()) if stat != "timestamp")
+            metric("sync_account_last_run_entries", "gauge", "Summary counters of each account's last run.", account_samples)
+            metric("sync_account_last_run_timestamp_seconds", "gauge", "When each account was last synced.",
+                   [("sync_account_last_run_timestamp_seconds", labels(account=a), float(stats["timestamp"])) for a, stats in sorted(self.accounts.items())])
+            if self.last_run:
+                metric("sync_last_run_timestamp_seconds", "gauge", "Start of the last run.", [("sync_last_run_timestamp_seconds", "", float(self.last_run["timestamp"]))])
+                metric("sync_last_run_duration_seconds", "gauge", "Duration of the last run.", [("sync_last_run_duration_seconds", "", float(self.last_run["duration_seconds"]))])
+                metric("sync_last_run_exit_code", "gauge", "Exit code of the last run (0 = success).", [("sync_last_run_exit_code", "", self.last_run["exit_code"])])
+        return "\n".join(lines) + "\n"
+
+
+METRICS = SyncMetrics(METRICS_LATENCY_BUCKETS)
+
+def metered_sleep(seconds, host, reason):
+    """time.sleep that is counted in the sleep metrics."""
+    METRICS.record_sleep(host, reason, seconds)
+    time.sleep(seconds)
+
+def write_metrics_file():
+    """Writes the metrics in METRICS_FORMAT (atomically, so scrapers never read a partial file)."""
+    if not METRICS_FORMAT: return
+    is_json = METRICS_FORMAT == "json"
+    metrics_file = _state_file_path(METRICS_FILE, "sync_metrics.json" if is_json else "sync_metrics.prom")
+    try:
+        with open(metrics_file + ".tmp", 'w') as f:
+            f.write(METRICS.to_json() if is_json else METRICS.to_prometheus())
+        os.replace(metrics_file + ".tmp", metrics_file)
+    except IOError as e:
+        print(f"Warning: Could not write metrics to {metrics_file}: {e}")
+
+def run_with_metrics(sync_fn):
+    """Runs one sync (single or multi-account), then records its outcome and writes the metrics file."""
+    started_at = time.time()
+    exit_code = sync_fn()
+    METRICS.record_run(started_at, time.time() - started_at, exit_code)
+    write_metrics_file()
+    return exit_code
+
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """Thread-safe token bucket: allows `rate` calls per `period` seconds, with bursts up to `capacity`."""
+    def __init__(self, rate, period, capacity=None, name=None):
+        self.name = name # Host name for sleep metrics
+        self.fill_rate = rate / float(period)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then consumes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.fill_rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            metered_sleep(wait, self.name, "rate_limit")
+
+    def set_tokens(self, tokens):
+        """Overrides the local estimate with a budget reported by the server."""
+        with self.lock:
+            self.tokens = max(0.0, min(self.capacity, float(tokens)))
+            self.updated_at = time.monotonic()
+
+
+def _parse_rate_limit_reset(value):
+    """Parses a reset time (epoch seconds or ISO 8601) into epoch seconds, or None."""
+    if value in (None, ""): return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+class HostRateLimiter:
+    """
+    Paces requests to one API host. A token bucket holds the expected budget; response headers
+    (Trakt X-Ratelimit, AniList X-RateLimit-Remaining/X-RateLimit-Reset, Retry-After) replace that
+    estimate with the server's own numbers, so requests only wait when the budget is actually low.
+    """
+    def __init__(self, name, rate, period, capacity=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, period, capacity, name)
+        self.blocked_until = 0.0 # Epoch seconds; set by Retry-After or an exhausted budget
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until a request to this host may be sent."""
+        while True:
+            with self.lock:
+                delay = self.blocked_until - time.time()
+            if delay <= 0: break
+            metered_sleep(delay, self.name, "retry_after")
+        self.bucket.acquire()
+
+    def update(self, response):
+        """Updates the budget from a response's rate limit headers."""
+        headers = response.headers
+        remaining = None; reset_at = None
+        trakt_limit = headers.get('X-Ratelimit') # Trakt: JSON {"remaining": .., "until": ..}
+        if trakt_limit and trakt_limit.lstrip().startswith('{'):
+            try:
+                trakt_limit = json.loads(trakt_limit)
+                remaining = trakt_limit.get('remaining')
+                reset_at = _parse_rate_limit_reset(trakt_limit.get('until'))
+            except (json.JSONDecodeError, AttributeError): pass
+        if remaining is None and headers.get('X-RateLimit-Remaining') is not None: # AniList
+            try: remaining = int(headers['X-RateLimit-Remaining'])
+            except ValueError: pass
+            reset_at = _parse_rate_limit_reset(headers.get('X-RateLimit-Reset'))
+
+        retry_after = headers.get('Retry-After')
+        if retry_after is None and response.status_code == 429 and reset_at is None:
+            retry_after = DEFAULT_RETRY_AFTER
+        with self.lock:
+            if retry_after is not None:
+                try: self.blocked_until = max(self.blocked_until, time.time() + float(retry_after))
+                except ValueError: self.blocked_until = max(self.blocked_until, time.time() + DEFAULT_RETRY_AFTER)
+            elif remaining is not None and remaining <= 0 and reset_at:
+                self.blocked_until = max(self.blocked_until, reset_at)
+        if remaining is not None:
+            self.bucket.set_tokens(remaining)
+
+
+# Budgets for each API host (MAL/AniList capacity kept small so bursts stay polite)
+TRAKT_GET_LIMITER = HostRateLimiter("Trakt", TRAKT_GET_RATE_LIMIT, TRAKT_GET_RATE_PERIOD)
+TRAKT_POST_LIMITER = HostRateLimiter("Trakt", TRAKT_POST_RATE_LIMIT, TRAKT_POST_RATE_PERIOD)
+ANILIST_LIMITER = HostRateLimiter("AniList", ANILIST_RATE_LIMIT, ANILIST_RATE_PERIOD, capacity=10)
+MAL_LIMITER = HostRateLimiter("MAL", MAL_RATE_LIMIT, MAL_RATE_PERIOD, capacity=5)
+
+# --- HTTP Response Cache ---
+class HttpResponseCache:
+    """
+    On-disk cache of GET responses for the endpoints in HTTP_CACHE_POLICIES: bodies are stored zlib-compressed
+    with their validators (ETag/Last-Modified), keyed by URL and the Authorization header (users never share
+    entries), and the least recently used ones are evicted above HTTP_CACHE_MAX_MB. Opened on first use.
+    """
+    STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "X-Pagination-Page", "X-Pagination-Limit",
+                      "X-Pagination-Page-Count", "X-Pagination-Item-Count")
+
+    def __init__(self, policies, max_bytes):
+        self.policies = [(re.compile(pattern), fresh_seconds) for pattern, fresh_seconds in policies]
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        """Returns the cache connection, opening it on first use (None if the cache is disabled or broken)."""
+        if self.conn is None and self.max_bytes > 0:
+            cache_file = _state_file_path(HTTP_CACHE_FILE, "http_cache.sqlite3")
+            try:
+                self.conn = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT NOT NULL,
+                        body BLOB NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL
+                    )""")
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: Could not open HTTP cache {cache_file}: {e}. Continuing without it.")
+                self.max_bytes = 0
+                self.conn = None
+        return self.conn
+
+    def policy(self, url):
+        """Returns the freshness (seconds) for a cacheable URL, or None if the URL isn't cached."""
+        if self.max_bytes <= 0: return None
+        path = urlsplit(url).path
+        for pattern, fresh_seconds in self.policies:
+            if pattern.search(path): return fresh_seconds
+        return None
+
+    @staticmethod
+    def key(url, headers):
+        authorization = headers.get("Authorization")
+        user = hashlib.sha1(authorization.encode()).hexdigest()[:16] if authorization else ""
+        return f"{user} {url}"
+
+    def lookup(self, key):
+        """Returns (etag, last_modified, headers, body, stored_at) for a key, or None."""
+        with self.lock:
+            conn = self._open()
+            if conn is None: return None
+            try:
+                row = conn.execute("SELECT etag, last_modified, headers, body, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if not row: return None
+                conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+                return row[0], row[1], json.loads(row[2]), zlib.decompress(row[3]), row[4]
+            except (sqlite3.Error, zlib.error, json.JSONDecodeError) as e:
+                tqdm.write(f"Warning: HTTP cache lookup failed: {e}")
+                return None
+
+    def store(self, key, response):
+        """Stores a 200 response, then evicts least recently used responses above the size limit."""
+        headers = {name: response.headers[name] for name in self.STORED_HEADERS if name in response.headers}
+        body = zlib.compress(response.content)
+        with self.lock:
+            conn = self._open()
+            if conn is None: return
+            try:
+                now = time.time()
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, headers.get("ETag"), headers.get("Last-Modified"), json.dumps(headers), body, len(body), now, now))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    for evict_key, size in conn.execute("SELECT key, size FROM responses ORDER BY used_at").fetchall():
+                        if total <= self.max_bytes: break
+                        conn.execute("DELETE FROM responses WHERE key = ?", (evict_key,))
+                        total -= size
+                conn.commit()
+            except sqlite3.Error as e:
+                tqdm.write(f"Warning: Could not store response in HTTP cache: {e}")
+
+    def touch(self, key):
+        """Marks a stored response as fresh again (after a 304)."""
+        with self.lock:
+            conn = self._open()
+            if conn is None: return
+            try:
+                conn.execute("UPDATE responses SET stored_at = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+            except sqlite3.Error as e:
+                tqdm.write(f"Warning: HTTP cache update failed: {e}")
+
+    @staticmethod
+    def build_response(url, headers, body):
+        """Builds a 200 response from a stored body, so callers can't tell it from a downloaded one."""
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = 'utf-8'
+        response.elapsed = datetime.timedelta(0)
+        response.from_cache = True
+        return response
+
+
+HTTP_CACHE = HttpResponseCache(HTTP_CACHE_POLICIES, HTTP_CACHE_MAX_MB * 1024 * 1024)
+
+# --- HTTP Clients ---
+class ApiClient:
+    """
+    HTTP client for one API host: a pooled keep-alive session, default headers set once,
+    and the host's rate limiters (per HTTP method). HTTP 429 is retried after the server-requested wait.
+    """
+    def __init__(self, name, headers=None, limiters=None, pool_size=10, session=None):
+        self.name = name
+        self.session = session
+        if session is None:
+            self.session = requests.Session()
+            self.set_pool_size(pool_size)
+        self.headers = dict(headers or {})
+        self.limiters = dict(limiters or {})
+
+    def set_pool_size(self, pool_size):
+        """Sets the number of keep-alive connections kept open (shared by all clients made with with_headers)."""
+        if getattr(self, 'pool_size', None) == pool_size: return # Keep the open connections
+        self.pool_size = pool_size
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def with_headers(self, headers, limiters=None):
+        """Returns a client sharing this client's connection pool, with additional default headers."""
+        return ApiClient(self.name, {**self.headers, **headers}, {**self.limiters, **(limiters or {})}, session=self.session)
+
+    def request(self, method, url, max_retries=3, headers=None, **kwargs):
+        """
+        Sends a request within the host's budget. Returns the last response.
+        GETs covered by HTTP_CACHE_POLICIES go through HTTP_CACHE: fresh responses are served locally,
+        older ones are revalidated and a 304 returns the stored body.
+        """
+        limiter = self.limiters.get(method)
+        request_headers = {**self.headers, **headers} if headers else self.headers
+        fresh_seconds = HTTP_CACHE.policy(url) if method == "GET" else None
+        if fresh_seconds is not None:
+            full_url = requests.Request(method, url, params=kwargs.get('params')).prepare().url
+            cache_key = HttpResponseCache.key(full_url, request_headers)
+            cached = HTTP_CACHE.lookup(cache_key)
+            if cached:
+                etag, last_modified, cached_headers, body, stored_at = cached
+                if time.time() - stored_at < fresh_seconds:
+                    METRICS.record_request(self.name, method, url, "cached", None)
+                    return HttpResponseCache.build_response(full_url, cached_headers, body)
+                validators = {"If-None-Match": etag} if etag else {}
+                if last_modified: validators["If-Modified-Since"] = last_modified
+                request_headers = {**request_headers, **validators}
+        for attempt in range(max_retries + 1):
+            if limiter: limiter.wait()
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=request_headers, **kwargs)
+            except requests.exceptions.RequestException:
+                METRICS.record_request(self.name, method, url, "error", time.monotonic() - started)
+                raise
+            METRICS.record_request(self.name, method, url, response.status_code, time.monotonic() - started)
+            if limiter: limiter.update(response)
+            response.attempts = attempt + 1 # > 1 means the request was rate limited (HTTP 429) first
+            if response.status_code != 429 or attempt == max_retries:
+                if fresh_seconds is not None:
+                    if response.status_code == 304 and cached:
+                        HTTP_CACHE.touch(cache_key)
+                        return HttpResponseCache.build_response(full_url, cached_headers, body)
+                    if response.status_code == 200 and (fresh_seconds > 0 or response.headers.get('ETag') or response.headers.get('Last-Modified')):
+                        HTTP_CACHE.store(cache_key, response)
+                return response
+            METRICS.record_retry(self.name, method, url)
+            tqdm.write(f"Rate limited by {self.name} (HTTP 429). Retrying after the server-requested wait...")
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+# One client per API host. The Trakt pool is sized for all search workers plus batch writes.
+TRAKT_CLIENT = ApiClient("Trakt", TRAKT_HEADERS, {"GET": TRAKT_GET_LIMITER, "POST": TRAKT_POST_LIMITER},
+                         pool_size=SEARCH_WORKERS + 2)
+ANILIST_CLIENT = ApiClient("AniList", {"Content-Type": "application/json"}, {"POST": ANILIST_LIMITER}, pool_size=2)
+MAL_CLIENT = ApiClient("MAL", limiters={"GET": MAL_LIMITER}, pool_size=2)
+ID_MAPPING_CLIENT = ApiClient("ID mapping", pool_size=1) # Downloads ID_MAPPING_URL
+
+def get_trakt_user_client(access_token, limiters=None):
+    """
+    Returns a Trakt client carrying the user's bearer token (shares TRAKT_CLIENT's connection pool).
+    limiters replaces the shared Trakt budgets, e.g. with new_trakt_user_limiters() for one of several accounts.
+    """
+    return TRAKT_CLIENT.with_headers({"Authorization": f"Bearer {access_token}"}, limiters)
+
+def new_trakt_user_limiters():
+    """Separate Trakt GET/POST budgets for one account (Trakt counts authenticated requests per user)."""
+    return {"GET": HostRateLimiter("Trakt", TRAKT_GET_RATE_LIMIT, TRAKT_GET_RATE_PERIOD),
+            "POST": HostRateLimiter("Trakt", TRAKT_POST_RATE_LIMIT, TRAKT_POST_RATE_PERIOD)}
+
 # --- Token Loading/Saving (Only Trakt) ---
 def load_tokens_generic(token_file):
     """Loads tokens from a specified file."""
@@ -71,20 +628,148 @@ def save_tokens_generic(tokens, token_file):
     except IOError as e:
         print(f"Error: Could not save tokens to {token_file}: {e}")
 
+# --- Sync State (persisted between runs) ---
+# Accounts synced in parallel share one state file
+SYNC_STATE_LOCK = threading.Lock()
+
+def load_sync_state():
+    """Loads the sync state file. Returns an empty state if missing or unreadable."""
+    state_file = _state_file_path(SYNC_STATE_FILE, "sync_state.json")
+    if os.path.exists(state_file):
+        try:
+            with open(state_file, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Warning: Could not load sync state {state_file}: {e}. Starting with a full sync.")
+    return {}
+
+def save_sync_state(state):
+    """Saves the sync state file."""
+    state_file = _state_file_path(SYNC_STATE_FILE, "sync_state.json")
+    try:
+        with open(state_file, 'w') as f:
+            json.dump(state, f, indent=4)
+    except IOError as e:
+        print(f"Error: Could not save sync state to {state_file}: {e}")
+
+def save_source_watermark(state, watermark_key, watermark):
+    """Records the newest source update seen by a successful run (merged into the current state file)."""
+    if watermark is None: return
+    state.setdefault('source_watermarks', {})[watermark_key] = watermark
+    with SYNC_STATE_LOCK:
+        current_state = load_sync_state()
+        current_state.setdefault('source_watermarks', {})[watermark_key] = watermark
+        save_sync_state(current_state)
+
+def get_source_entry_updated_at(entry):
+    """Returns when a raw MAL/AniList list entry was last updated (epoch seconds), or None."""
+    if 'list_status' in entry: # MAL: ISO 8601 string
+        updated_at = (entry.get('list_status') or {}).get('updated_at')
+        if not updated_at: return None
+        try: return datetime.datetime.fromisoformat(updated_at.replace('Z', '+00:00')).timestamp()
+        except ValueError: return None
+    return entry.get('updatedAt') # AniList: epoch seconds
+
+def _filter_updated_since(entries, updated_since):
+    """Keeps entries updated after the watermark. Returns (entries, watermark_reached)."""
+    if updated_since is None: return entries, False
+    fresh = [e for e in entries if (get_source_entry_updated_at(e) or 0) > updated_since]
+    return fresh, len(fresh) < len(entries)
+
+# --- Resume Journal ---
+# Append-only JSON lines written during a run: a 'start' record (the watermark the run fetched from), an
+# 'entry' record per processed source entry with its Trakt match (or null) and the batches it still waits for,
+# a 'batch' record per batch Trakt acknowledged, and 'done' when the run finished. Successful runs delete the
+# journal. Resuming reuses the journaled matches, so it doesn't depend on the match cache.
+
+class SyncJournal:
+    """Writes one run's journal (see above)."""
+    def __init__(self, journal_file, updated_since, resume=False):
+        self.journal_file = journal_file
+        self.lock = threading.Lock() # Entries are written by the search loop, batches by the Trakt writer
+        try:
+            self.file = open(journal_file, 'a' if resume else 'w')
+            if not resume: self.write({"t": "start", "updated_since": updated_since, "at": time.time()}, flush=True)
+        except IOError as e:
+            print(f"Warning: Could not open run journal {journal_file}: {e}. This run can't be resumed.")
+            self.file = None
+
+    def write(self, record, flush=False):
+        with self.lock:
+            if self.file is None: return
+            self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+            if flush: self.file.flush()
+
+    def record_entry(self, source_id, pending_batches, trakt_match=None):
+        """
+        pending_batches: the batches ('history', 'ratings') the entry was added to; empty if nothing to send.
+        trakt_match: the entry's Trakt match (search_trakt's result shape), None if it has none.
+        """
+        match = None
+        if trakt_match and trakt_match.get('type') in ('show', 'movie'):
+            item = trakt_match.get(trakt_match['type']) or {}
+            match = {"type": trakt_match['type'], trakt_match['type']: {"title": item.get('title'), "year": item.get('year'), "ids": item.get('ids')}}
+        self.write({"t": "entry", "id": str(source_id), "match": match, "pending": pending_batches})
+
+    def record_batch(self, kind, source_ids):
+        """Records a batch Trakt acknowledged (flushed right away, it's what resuming relies on)."""
+        self.write({"t": "batch", "kind": kind, "ids": [str(i) for i in source_ids]}, flush=True)
+
+    def close(self, finished=False):
+        """Closes the journal; a finished run's journal is deleted since there is nothing left to resume."""
+        with self.lock:
+            if self.file is None: return
+            self.file.close()
+            self.file = None
+        if finished:
+            try: os.remove(self.journal_file)
+            except OSError as e: print(f"Warning: Could not remove run journal {self.journal_file}: {e}")
+
+def load_sync_journal(journal_file):
+    """
+    Reads an interrupted run's journal. Returns (updated_since, done_source_ids, matches): the watermark that run
+    fetched from, the source IDs it fully handled and the Trakt matches of the entries whose batches didn't
+    reach Trakt (source ID -> search_trakt result). Returns None if there is nothing to resume.
+    """
+    if not os.path.exists(journal_file): return None
+    start = None; waiting = {}; done = set(); matches = {}
+    try:
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try: record = json.loads(line)
+                except json.JSONDecodeError: break # Torn last line of a killed run
+                kind = record.get('t')
+                if kind == 'start': start = record
+                elif kind == 'entry':
+                    if record.get('pending'): waiting[record['id']] = set(record['pending'])
+                    else: done.add(record['id'])
+                    if record.get('match'): matches[record['id']] = record['match']
+                elif kind == 'batch':
+                    for source_id in record.get('ids', []):
+                        if source_id not in waiting: continue
+                        waiting[source_id].discard(record['kind'])
+                        if not waiting[source_id]: done.add(source_id); del waiting[source_id]
+                elif kind == 'done': return None
+    except IOError as e:
+        print(f"Warning: Could not read run journal {journal_file}: {e}. Starting a normal run.")
+        return None
+    if start is None: return None
+    return start.get('updated_since'), done, {source_id: match for source_id, match in matches.items() if source_id not in done}
+
 # --- Trakt Authentication ---
 
-def load_trakt_tokens():
-    return load_tokens_generic(TRAKT_TOKEN_FILE)
+def load_trakt_tokens(token_file=None):
+    return load_tokens_generic(token_file or TRAKT_TOKEN_FILE)
 
-def save_trakt_tokens(tokens):
-    save_tokens_generic(tokens, TRAKT_TOKEN_FILE)
+def save_trakt_tokens(tokens, token_file=None):
+    save_tokens_generic(tokens, token_file or TRAKT_TOKEN_FILE)
 
 def get_trakt_device_code():
     """Gets a device code for Trakt authentication."""
     url = f"{TRAKT_API_URL}/oauth/device/code"
     payload = {"client_id": TRAKT_CLIENT_ID}
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = TRAKT_CLIENT.post(url, json=payload, timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.Timeout:
@@ -110,9 +795,9 @@ def poll_trakt_token(device_code_info):
 
     print("Polling for Trakt authorization...")
     while time.time() - start_time < expires_in:
-        time.sleep(interval)
+        metered_sleep(interval, "Trakt", "auth_poll")
         try:
-            response = requests.post(url, json=payload, timeout=10)
+            response = TRAKT_CLIENT.post(url, max_retries=0, json=payload, timeout=10) # 429 is handled below
             status_code = response.status_code
             if status_code == 200:
                 print("Trakt Authentication successful!")
@@ -123,13 +808,13 @@ def poll_trakt_token(device_code_info):
             elif status_code in [404, 410]: print("Error: Trakt Device code expired."); return None
             elif status_code == 409: print("Error: Trakt Device code already used."); return None
             elif status_code == 418: print("Error: User denied Trakt authorization."); return None
-            elif status_code == 429: print("Warning: Rate limited by Trakt during auth. Waiting longer..."); time.sleep(interval * 2)
+            elif status_code == 429: print("Warning: Rate limited by Trakt during auth. Waiting longer..."); metered_sleep(interval * 2, "Trakt", "auth_poll")
             else: response.raise_for_status() # Raise for other unexpected errors
         except requests.exceptions.Timeout:
             print("Warning: Timeout polling for Trakt token.")
         except requests.exceptions.RequestException as e:
             print(f"Error polling for Trakt token: {e}")
-            time.sleep(5)
+            metered_sleep(5, "Trakt", "auth_poll")
 
     print("Error: Trakt Authentication timed out.")
     return None
@@ -146,7 +831,7 @@ def refresh_trakt_token(refresh_token):
         "grant_type": "refresh_token",
     }
     try:
-        response = requests.post(url, json=payload, timeout=15)
+        response = TRAKT_CLIENT.post(url, json=payload, timeout=15)
         response.raise_for_status()
         tokens = response.json()
         tokens['acquired_at'] = time.time()
@@ -161,33 +846,37 @@ def refresh_trakt_token(refresh_token):
         print(f"Response content: {response_text}")
         return None
 
-def get_trakt_access_token():
-    """Handles the entire Trakt authentication process (load, auth, refresh)."""
-    tokens = load_trakt_tokens()
+def get_trakt_access_token(token_file=None, min_valid_seconds=86400):
+    """
+    Handles the entire Trakt authentication process (load, auth, refresh) for one token file.
+    The token is refreshed ahead of time if it expires within min_valid_seconds.
+    """
+    token_file = token_file or TRAKT_TOKEN_FILE
+    tokens = load_trakt_tokens(token_file)
     if tokens:
         expires_at = tokens.get('acquired_at', 0) + tokens.get('expires_in', 0)
-        # Use a buffer (e.g., 1 day = 86400 seconds)
-        if time.time() < expires_at - 86400:
+        # Use a buffer (default 1 day = 86400 seconds)
+        if time.time() < expires_at - min_valid_seconds:
             return tokens.get('access_token')
         elif 'refresh_token' in tokens:
             print("Trakt token expired, attempting refresh...")
             new_tokens = refresh_trakt_token(tokens['refresh_token'])
             if new_tokens:
-                save_trakt_tokens(new_tokens)
+                save_trakt_tokens(new_tokens, token_file)
                 return new_tokens.get('access_token')
             else:
                 print("Trakt token refresh failed. Need to re-authenticate.")
-                if os.path.exists(TRAKT_TOKEN_FILE):
-                    try: os.remove(TRAKT_TOKEN_FILE)
+                if os.path.exists(token_file):
+                    try: os.remove(token_file)
                     except OSError as e: print(f"Error removing token file: {e}")
         else:
             print("Trakt token expired and no refresh token found. Need to re-authenticate.")
-            if os.path.exists(TRAKT_TOKEN_FILE):
-                try: os.remove(TRAKT_TOKEN_FILE)
+            if os.path.exists(token_file):
+                try: os.remove(token_file)
                 except OSError as e: print(f"Error removing token file: {e}")
 
     # --- Perform Device Authentication Flow ---
-    print("\n--- Trakt Authentication Required ---")
+    print(f"\n--- Trakt Authentication Required ({token_file}) ---")
     device_code_info = get_trakt_device_code()
     if not device_code_info: return None
 
@@ -198,7 +887,7 @@ def get_trakt_access_token():
 
     new_tokens = poll_trakt_token(device_code_info)
     if new_tokens:
-        save_trakt_tokens(new_tokens)
+        save_trakt_tokens(new_tokens, token_file)
         return new_tokens.get('access_token')
     else:
         print("Trakt authentication failed.")
@@ -206,13 +895,87 @@ def get_trakt_access_token():
 
 # --- Data Fetching ---
 
-def get_anilist_data(username):
-    """Fetches all COMPLETED and CURRENT anime for a given AniList user."""
+# Only the list entry fields the sync reads (status/type for filtering, updatedAt for the incremental watermark)
+ANILIST_LIST_ENTRY_FIELDS = """status score(format: POINT_100) progress completedAt { year month day } updatedAt
+                media { id title { romaji english native } synonyms format type episodes startDate { year } }"""
+
+def iter_anilist_collection(username):
+    """
+    Yields the COMPLETED and CURRENT anime of a given AniList user via MediaListCollection:
+    the whole list in one request, or one request per ANILIST_COLLECTION_CHUNK_SIZE entries for very large lists.
+    Yields None (and stops) if a chunk could not be fetched.
+    """
+    query = """
+    query ($username: String, $type: MediaType, $chunk: Int, $perChunk: Int) {
+        MediaListCollection (userName: $username, type: $type, status_in: [COMPLETED, CURRENT],
+                             chunk: $chunk, perChunk: $perChunk, forceSingleCompletedList: true) {
+            hasNextChunk
+            lists { isCustomList entries { %s } }
+        }
+    }""" % ANILIST_LIST_ENTRY_FIELDS
+    variables = {"username": username, "type": "ANIME", "perChunk": ANILIST_COLLECTION_CHUNK_SIZE}
+    print(f"Fetching ANIME list for user '{username}' from AniList (MediaListCollection)...")
+    chunk = 1
+    has_next_chunk = True
+    while has_next_chunk:
+        variables["chunk"] = chunk
+        response = None
+        try:
+            response = ANILIST_CLIENT.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=60)
+            response.raise_for_status()
+            data = response.json()
+            if "errors" in data and data["errors"]:
+                print(f"AniList API Error: {data['errors']}")
+                yield None; return
+            collection = (data.get('data') or {}).get('MediaListCollection')
+            if not collection:
+                print(f"Warning: No list data received from AniList for chunk {chunk}.")
+                yield None; return
+            # Custom lists repeat entries that are already in the status lists
+            anime_list = [e for media_list in collection.get('lists') or [] if not media_list.get('isCustomList')
+                          for e in media_list.get('entries') or [] if e.get('media', {}).get('type') == 'ANIME']
+            yield anime_list
+            has_next_chunk = collection.get('hasNextChunk', False)
+            print(f"Fetched chunk {chunk} ({len(anime_list)} entries){'...' if has_next_chunk else '. No more chunks.'}")
+            chunk += 1
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching chunk {chunk} from AniList: {e} - Status: {getattr(response, 'status_code', 'N/A')}")
+            yield None; return
+        except json.JSONDecodeError:
+            print(f"Error decoding AniList response chunk {chunk}. Content: {getattr(response, 'text', '')[:200]}")
+            yield None; return
+
+
+def iter_anilist_entries(username, updated_since=None):
+    """
+    Yields the COMPLETED and CURRENT anime of a given AniList user in batches, using ANILIST_FETCH_MODE.
+    Incremental runs always page newest-first, since they usually stop after the first page.
+    Falls back to paging if the collection query fails before returning anything.
+    """
+    if ANILIST_FETCH_MODE == "collection" and updated_since is None and username and "YOUR_ANILIST_USERNAME" not in username:
+        fetched_any = False
+        for chunk_entries in iter_anilist_collection(username):
+            if chunk_entries is None:
+                if fetched_any: yield None; return # Can't switch modes without re-sending processed entries
+                print("Falling back to fetching the AniList list page by page...")
+                break
+            fetched_any = True
+            yield chunk_entries
+        else:
+            return
+    yield from iter_anilist_pages(username, updated_since)
+
+
+def iter_anilist_pages(username, updated_since=None):
+    """
+    Yields the COMPLETED and CURRENT anime of a given AniList user one page at a time, as each page arrives.
+    With updated_since (epoch seconds), the list is read newest-first and paging stops at older entries.
+    Yields None (and stops) if a page could not be fetched.
+    """
     if not username or "YOUR_ANILIST_USERNAME" in username:
          print("Error: ANILIST_USERNAME not set correctly.")
-         return None
+         yield None; return
 
-    all_entries = []
     page = 1
     has_next_page = True
     # GraphQL query to get relevant fields
@@ -220,242 +983,719 @@ def get_anilist_data(username):
     query ($username: String, $page: Int, $perPage: Int, $type: MediaType) {
         Page (page: $page, perPage: $perPage) {
             pageInfo { hasNextPage }
-            mediaList (userName: $username, type: $type, status_in: [COMPLETED, CURRENT]) {
-                status score(format: POINT_100) progress
-                startedAt { year month day } completedAt { year month day } updatedAt
-                media {
-                    idMal id title { romaji english native }
-                    format type startDate { year }
-                }
+            mediaList (userName: $username, type: $type, status_in: [COMPLETED, CURRENT], sort: [UPDATED_TIME_DESC]) {
+                %s
             }
         }
-    }"""
+    }""" % ANILIST_LIST_ENTRY_FIELDS
     variables = {"username": username, "perPage": 50, "type": "ANIME"}
     print(f"Fetching ANIME list for user '{username}' from AniList...")
     while has_next_page:
         variables["page"] = page
         try:
-            time.sleep(SOURCE_API_DELAY)
-            response = requests.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=20)
+            response = ANILIST_CLIENT.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=20)
             response.raise_for_status()
             data = response.json()
             if "errors" in data and data["errors"]: # Check if errors list is not empty
                 print(f"AniList API Error: {data['errors']}")
-                return None
+                yield None; return
             page_data = data.get('data', {}).get('Page', {})
             if not page_data:
                  print(f"Warning: No page data received from AniList for page {page}. Stopping.")
-                 break
+                 return
             media_list = page_data.get('mediaList', [])
             # Filter for ANIME type just in case query filter fails
             anime_list = [e for e in media_list if e.get('media', {}).get('type') == 'ANIME']
-            all_entries.extend(anime_list)
-            has_next_page = page_data.get('pageInfo', {}).get('hasNextPage', False)
+            anime_list, watermark_reached = _filter_updated_since(anime_list, updated_since)
+            yield anime_list
+            has_next_page = page_data.get('pageInfo', {}).get('hasNextPage', False) and not watermark_reached
             if has_next_page: print(f"Fetched page {page}..."); page += 1;
             else: print(f"Fetched page {page}. No more pages.")
         except requests.exceptions.Timeout:
             print(f"Error: Timeout fetching page {page} from AniList. Retrying once...")
-            time.sleep(5) # Wait before retry
+            metered_sleep(5, "AniList", "timeout_retry") # Wait before retry
             try: # Simple retry logic
-                 response = requests.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=30)
+                 response = ANILIST_CLIENT.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=30)
                  response.raise_for_status()
                  data = response.json()
-                 if "errors" in data and data["errors"]: print(f"AniList API Error on retry: {data['errors']}"); return None
+                 if "errors" in data and data["errors"]: print(f"AniList API Error on retry: {data['errors']}"); yield None; return
                  page_data = data.get('data', {}).get('Page', {})
-                 if not page_data: print(f"Warning: No page data received on retry page {page}. Stopping."); break
+                 if not page_data: print(f"Warning: No page data received on retry page {page}. Stopping."); return
                  media_list = page_data.get('mediaList', [])
                  anime_list = [e for e in media_list if e.get('media', {}).get('type') == 'ANIME']
-                 all_entries.extend(anime_list)
-                 has_next_page = page_data.get('pageInfo', {}).get('hasNextPage', False)
+                 anime_list, watermark_reached = _filter_updated_since(anime_list, updated_since)
+                 yield anime_list
+                 has_next_page = page_data.get('pageInfo', {}).get('hasNextPage', False) and not watermark_reached
                  if has_next_page: print(f"Fetched page {page} (after retry)..."); page += 1;
                  else: print(f"Fetched page {page} (after retry). No more pages.")
             except Exception as e_retry:
                  print(f"Error fetching page {page} from AniList even after retry: {e_retry}")
-                 return None # Abort on retry failure
+                 yield None; return # Abort on retry failure
         except requests.exceptions.RequestException as e:
             response_text = getattr(response, 'text', 'No response text available')
             print(f"Error fetching page {page} from AniList: {e}")
             print(f"Status: {getattr(response, 'status_code', 'N/A')}, Text: {response_text[:200]}")
-            return None
+            yield None; return
         except json.JSONDecodeError:
             response_text = getattr(response, 'text', 'No response text available')
             print(f"Error decoding AniList response page {page}. Content: {response_text[:200]}")
-            return None
-    print(f"Found {len(all_entries)} anime entries on AniList for user '{username}'.")
+            yield None; return
+
+
+def get_anilist_data(username, updated_since=None):
+    """Fetches all COMPLETED and CURRENT anime for a given AniList user as one list (None on failure)."""
+    all_entries = []
+    for page_entries in iter_anilist_entries(username, updated_since):
+        if page_entries is None: return None
+        all_entries.extend(page_entries)
+    if updated_since is not None:
+        print(f"Found {len(all_entries)} anime entries updated since the last sync on AniList for user '{username}'.")
+    else:
+        print(f"Found {len(all_entries)} anime entries on AniList for user '{username}'.")
     return all_entries
 
 
-def get_mal_anime_list(username, client_id):
-    """Fetches all completed and watching anime for a specific MAL user (unauthenticated)."""
+def iter_mal_pages(username, client_id, updated_since=None):
+    """
+    Yields the completed and watching anime of a specific MAL user (unauthenticated) one page at a time.
+    MAL_FETCH_MODE 'single' reads the whole list once and keeps completed/watching entries locally;
+    'status' requests each status list separately.
+    With updated_since (epoch seconds), each list is read newest-first and paging stops at older entries.
+    Yields None (and stops) if a page could not be fetched.
+    """
     if not username or "YOUR_MAL_USERNAME" in username:
         print("Error: MAL_USERNAME is not set in the script configuration.")
-        return None
+        yield None; return
     if not client_id or "YOUR_MAL_CLIENT_ID" in client_id:
          print("Error: MAL_CLIENT_ID is not set correctly in the script.")
-         return None
+         yield None; return
 
-    all_entries = []
-    # Request fields needed for processing and Trakt matching
+    fetch_failed = False
+    # Request only the fields needed for processing and Trakt matching
     # node fields doc: https://myanimelist.net/apiconfig/references/api/v2#operation/users_user_id_animelist_get
-    fields = "fields=list_status{status,score,start_date,finish_date,updated_at},node{id,title,alternative_titles{en},media_type,start_date}"
-    # Fetch both completed and watching (though only completed are synced currently)
+    fields = "fields=list_status{status,score,num_episodes_watched,finish_date,updated_at},node{id,title,alternative_titles,media_type,start_date,num_episodes}"
+    # Completed entries are synced in full, watching entries up to their progress (SYNC_WATCHING_PROGRESS)
     statuses = ["completed", "watching"]
-    limit = 100 # MAL API limit per page
+    limit = 1000 # MAL API max per page for user lists
+    # None = one unfiltered pass over the whole list
+    passes = [None] if MAL_FETCH_MODE == "single" else statuses
 
-    mal_headers = {
-        "X-MAL-CLIENT-ID": client_id
-    }
+    mal_client = MAL_CLIENT.with_headers({"X-MAL-CLIENT-ID": client_id})
 
     print(f"Fetching ANIME list for user '{username}' from MyAnimeList (public API)...")
     print("Ensure the user's MAL Anime List is set to Public in their profile settings.")
 
-    for status in statuses:
+    for status_filter in passes:
+        status = status_filter or "all"
         print(f"Fetching '{status}' list for '{username}'...")
         # Endpoint for specific user's list
-        url = f"{MAL_API_URL}/users/{username}/animelist?{fields}&status={status}&limit={limit}&nsfw=1" # Include NSFW by default
+        # Sorted newest-first so incremental runs can stop at the watermark
+        url = f"{MAL_API_URL}/users/{username}/animelist?{fields}&sort=list_updated_at&limit={limit}&nsfw=1" # Include NSFW by default
+        if status_filter: url += f"&status={status_filter}"
 
         page_num = 1
-        while url:
+        while url and not fetch_failed:
             try:
-                time.sleep(SOURCE_API_DELAY) # Delay before request
-                response = requests.get(url, headers=mal_headers, timeout=20)
+                response = mal_client.get(url, timeout=20)
 
                 # Handle specific HTTP errors for MAL public access
                 if response.status_code == 404:
                      print(f"Error: Received 404 Not Found when fetching '{status}' list for user '{username}'.")
                      print("Please double-check the MAL_USERNAME in the script configuration.")
-                     url = None; continue
+                     fetch_failed = True; url = None; continue
                 elif response.status_code == 403:
                      print(f"Error: Received 403 Forbidden when fetching '{status}' list for user '{username}'.")
                      print("This usually means the user's list is private.")
                      print("Ensure the target MAL list is set to 'Public'. Cannot proceed with private lists.")
-                     url = None; continue
+                     fetch_failed = True; url = None; continue
 
                 response.raise_for_status() # Check for other HTTP errors (429, 5xx)
                 data = response.json()
 
-                entries = data.get('data', [])
-                all_entries.extend(entries)
+                entries, watermark_reached = _filter_updated_since(data.get('data', []), updated_since)
+                entries = [e for e in entries if (e.get('list_status') or {}).get('status') in statuses]
+                yield entries
                 print(f"Fetched page {page_num} for status '{status}' ({len(entries)} items)...")
 
                 # Get URL for next page from MAL's paging object
-                url = data.get('paging', {}).get('next')
+                url = data.get('paging', {}).get('next') if not watermark_reached else None
                 page_num += 1
 
             except requests.exceptions.Timeout:
                 print(f"Error: Timeout fetching page {page_num} (status: {status}) from MAL for user '{username}'. Retrying once...")
-                time.sleep(5)
+                metered_sleep(5, "MAL", "timeout_retry")
                 try: # Simple retry
-                    response = requests.get(url, headers=mal_headers, timeout=30)
+                    response = mal_client.get(url, timeout=30)
                     # Repeat 404/403 checks on retry
-                    if response.status_code == 404: print(f"Error on retry: 404 Not Found for user '{username}'. Check username."); url = None; continue
-                    if response.status_code == 403: print(f"Error on retry: 403 Forbidden for user '{username}'. Check list privacy."); url = None; continue
+                    if response.status_code == 404: print(f"Error on retry: 404 Not Found for user '{username}'. Check username."); fetch_failed = True; url = None; continue
+                    if response.status_code == 403: print(f"Error on retry: 403 Forbidden for user '{username}'. Check list privacy."); fetch_failed = True; url = None; continue
                     response.raise_for_status()
                     data = response.json()
-                    entries = data.get('data', [])
-                    all_entries.extend(entries)
+                    entries, watermark_reached = _filter_updated_since(data.get('data', []), updated_since)
+                    entries = [e for e in entries if (e.get('list_status') or {}).get('status') in statuses]
+                    yield entries
                     print(f"Fetched page {page_num} (status: {status}) after retry...")
-                    url = data.get('paging', {}).get('next')
+                    url = data.get('paging', {}).get('next') if not watermark_reached else None
                     page_num += 1
                 except Exception as e_retry:
                     print(f"Error fetching MAL page {page_num} (status: {status}) even after retry: {e_retry}")
-                    url = None # Stop fetching for this status on retry failure
+                    fetch_failed = True; url = None # Stop fetching for this status on retry failure
             except requests.exceptions.HTTPError as e:
                  print(f"HTTP Error fetching MAL page {page_num} (status: {status}): {e}")
                  if response is not None:
                      print(f"Status: {response.status_code}, Response: {response.text[:500]}")
                      if response.status_code == 429:
-                          print("Rate limited by MAL API. Try increasing SOURCE_API_DELAY in script config.")
-                 url = None # Stop fetching for this status
+                          print("Rate limited by MAL API. Try decreasing MAL_RATE_LIMIT in script config.")
+                 fetch_failed = True; url = None # Stop fetching for this status
             except requests.exceptions.RequestException as e:
                 print(f"Error fetching MAL page {page_num} (status: {status}): {e}")
-                url = None
+                fetch_failed = True; url = None
             except json.JSONDecodeError:
                 response_text = getattr(response, 'text', 'No response text available')
                 print(f"Error decoding MAL response page {page_num} (status: {status}). Content: {response_text[:200]}")
-                url = None
+                fetch_failed = True; url = None
 
-    print(f"Found {len(all_entries)} total public anime entries (completed & watching) for user '{username}' on MyAnimeList.")
+        if fetch_failed:
+            # A partial list would let the watermark skip entries that were never fetched
+            yield None; return
+
+
+def get_mal_anime_list(username, client_id, updated_since=None):
+    """
+    Fetches all completed and watching anime for a specific MAL user (unauthenticated) as one list.
+    Returns None if any page could not be fetched.
+    """
+    all_entries = []
+    for page_entries in iter_mal_pages(username, client_id, updated_since):
+        if page_entries is None: return None
+        all_entries.extend(page_entries)
+    if updated_since is not None:
+        print(f"Found {len(all_entries)} public anime entries (completed & watching) updated since the last sync for user '{username}' on MyAnimeList.")
+    else:
+        print(f"Found {len(all_entries)} total public anime entries (completed & watching) for user '{username}' on MyAnimeList.")
     return all_entries
 
 
-def search_trakt(title_main, title_english, source_id_logging, year, media_format, access_token):
-    """Searches Trakt for a show or movie using title and year."""
-    search_headers = {**TRAKT_HEADERS, "Authorization": f"Bearer {access_token}"}
-    trakt_type = None
-    # Map source format to Trakt type ('show' or 'movie')
+# Formats Trakt may list as either a show or a movie; searched as both types in one request
+AMBIGUOUS_MEDIA_FORMATS = ["OVA", "ova", "ONA", "ona", "SPECIAL", "special"]
+
+def get_trakt_type_for_format(media_format):
+    """Maps a MAL/AniList media format to a Trakt type ('show' or 'movie'), or None if unsupported."""
     if media_format in ["TV", "tv", "OVA", "ova", "ONA", "ona", "SPECIAL", "special", "TV_SHORT"]:
-        trakt_type = "show"
+        return "show"
     elif media_format in ["MOVIE", "movie"]:
-        trakt_type = "movie"
-    else:
+        return "movie"
+    return None
+
+
+def normalize_title(title):
+    """Lowercases a title and removes accents/diacritics and punctuation, for comparing titles."""
+    nfkd_form = unicodedata.normalize('NFKD', title)
+    title = "".join([c for c in nfkd_form if not unicodedata.combining(c)]).lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in title).split())
+
+def _score_search_candidate(result, position, titles, year, trakt_type):
+    """
+    Ranks one Trakt search result: best title similarity against all known titles, plus a bonus for
+    Trakt's own ordering, a matching year (or penalty for a different one) and the expected type.
+    Candidates below TRAKT_MATCH_MIN_SIMILARITY score 0, so the bonuses alone never make a match:
+
+    >>> walking_dead = {'type': 'show', 'show': {'title': 'The Walking Dead', 'year': 2009}}
+    >>> _score_search_candidate(walking_dead, 0, ['kimi ni todoke'], 2009, 'show')
+    0.0
+    >>> kimi_ni_todoke = {'type': 'show', 'show': {'title': 'Kimi ni Todoke: From Me to You', 'year': 2009}}
+    >>> _score_search_candidate(kimi_ni_todoke, 1, ['kimi ni todoke'], 2009, 'show') >= TRAKT_MATCH_MIN_SCORE
+    True
+    """
+    item = result.get(result.get('type'), {}) or {}
+    candidate_title = normalize_title(item.get('title') or "")
+    similarity = max((difflib.SequenceMatcher(None, title, candidate_title).ratio() for title in titles), default=0.0)
+    if similarity < TRAKT_MATCH_MIN_SIMILARITY: return 0.0 # Unrelated title
+    score = 0.6 * similarity + max(0.0, 0.2 - 0.02 * position)
+    if year and item.get('year'):
+        try:
+            year_difference = abs(int(item['year']) - int(year))
+            score += 0.2 if year_difference == 0 else 0.1 if year_difference == 1 else -0.2
+        except (ValueError, TypeError): pass
+    if result.get('type') == trakt_type: score += 0.05
+    return score
+
+# Sequel/part suffixes dropped from search queries: "Season 2", "2nd Season", "Part 2", "Cour 2", "(TV)"
+SEARCH_QUERY_SUFFIX_PATTERN = re.compile(
+    r"\b(?:season|part|cour)\s*\d+\b|\b\d+(?:st|nd|rd|th)\s+(?:season|part|cour)\b|\((?:tv|ova|ona|movie)\)", re.IGNORECASE)
+
+def canonical_search_query(title):
+    """
+    Turns a title into the query sent to Trakt: accents/diacritics removed, sequel suffixes dropped, lowercase.
+    Sequels and variants of one franchise share a query (and its response); ranking still uses the full titles.
+    """
+    try:
+        nfkd_form = unicodedata.normalize('NFKD', title)
+        title = "".join([c for c in nfkd_form if not unicodedata.combining(c)])
+    except Exception: pass # Keep the title as is if normalization fails
+    query = " ".join(SEARCH_QUERY_SUFFIX_PATTERN.sub(" ", title).split()).strip(" :-~").lower()
+    return (query or " ".join(title.split()).lower())[:100]
+
+
+class SearchResponseCache:
+    """
+    Shares Trakt search responses within a run: entries searching the same (query, types) wait for the
+    request already in flight or reuse its completed response instead of sending their own. Failed
+    requests are not kept, so the next entry tries again.
+    """
+    def __init__(self):
+        self.responses = {} # key -> Future with the parsed results
+        self.shared = 0 # Searches answered without a request of their own
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Returns the response for key, calling fetch() only if no other search for key ran or is running."""
+        with self.lock:
+            future = self.responses.get(key)
+            owner = future is None
+            if owner: future = self.responses[key] = Future()
+            else: self.shared += 1
+        if owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                with self.lock: del self.responses[key]
+                future.set_exception(e)
+        return future.result()
+
+
+def _fetch_trakt_search_results(query, search_types, trakt_client):
+    """Sends one Trakt title search. Returns the results list ([] if Trakt answered 404)."""
+    # Shared Trakt GET budget across search workers
+    response = trakt_client.get(f"{TRAKT_API_URL}/search/{search_types}",
+                                params={"query": query, "limit": TRAKT_SEARCH_LIMIT}, timeout=15)
+    if response.status_code == 404: return []
+    response.raise_for_status() # Handle other errors (401, 429, 5xx)
+    return response.json()
+
+# Returned instead of a match when Trakt could not be searched (timeouts, server errors, rate limits after retries).
+# Unlike None (no acceptable candidate) it is not recorded as a miss; the entry is searched again next run.
+TRAKT_SEARCH_FAILED = object()
+
+def search_trakt(title_main, title_english, source_id_logging, year, media_format, trakt_client, alt_titles=(), search_cache=None):
+    """
+    Searches Trakt for a show or movie by title. One request asks for TRAKT_SEARCH_LIMIT candidates (both
+    types for ambiguous formats like ONA), which are ranked locally against every known title (romaji,
+    English, native, synonyms), the year and the expected type. The next title is only searched when
+    Trakt returned nothing at all. Queries are canonical (see canonical_search_query), and with a
+    SearchResponseCache entries with the same query share one request.
+    Returns the best result, None if Trakt has no acceptable candidate, or TRAKT_SEARCH_FAILED if a
+    search failed and no other title matched.
+    """
+    # Map source format to Trakt type ('show' or 'movie')
+    trakt_type = get_trakt_type_for_format(media_format)
+    if not trakt_type:
         # Silently skip unsupported formats like MUSIC, UNKNOWN
         return None
+    search_types = "show,movie" if media_format in AMBIGUOUS_MEDIA_FORMATS else trakt_type
 
-    display_title = title_english or title_main # For logging purposes
-
-    # Create a list of unique, non-empty titles to search
-    search_titles = list(dict.fromkeys(filter(None, [title_english, title_main])))
+    # Create a list of unique, non-empty titles to search (English first, then romaji)
+    search_titles = list(dict.fromkeys(t for t in [title_english, title_main] if t and t.strip()))
     if not search_titles:
         return None # Skip if no usable titles
+    known_titles = [t for t in dict.fromkeys(normalize_title(t) for t in search_titles + [t for t in alt_titles if t]) if t]
 
-    for title in search_titles:
-        if not title.strip(): continue
-
-        # Basic title normalization (remove accents/diacritics)
-        try:
-            nfkd_form = unicodedata.normalize('NFKD', title)
-            normalized_title = "".join([c for c in nfkd_form if not unicodedata.combining(c)])
-            if not normalized_title.strip(): continue
-        except Exception:
-            normalized_title = title # Fallback if normalization fails
-
-        # Prepare URL-encoded query, limit length
-        query = requests.utils.quote(normalized_title[:100].encode('utf-8'))
-        search_url = f"{TRAKT_API_URL}/search/{trakt_type}?query={query}"
-        # Add year filter if available for better matching
-        if year:
-             search_url += f"&years={year}"
-
+    search_failed = False
+    for query in dict.fromkeys(canonical_search_query(t) for t in search_titles):
+        if not query.strip(): continue
         try:
-            time.sleep(0.4) # Small delay between Trakt search API calls
-            response = requests.get(search_url, headers=search_headers, timeout=15)
-
-            if response.status_code == 404:
-                 continue # Title not found, try next title variation if available
-
-            response.raise_for_status() # Handle other errors (401, 429, 5xx)
-            results = response.json()
-
-            if results:
-                # Basic check: Does the year in the result match the input year?
-                trakt_result_year_str = results[0].get(trakt_type, {}).get('year')
-                if year and trakt_result_year_str:
-                    try:
-                        if int(trakt_result_year_str) != int(year):
-                            # Year mismatch, likely not the correct item, try next search title
-                            continue
-                    except (ValueError, TypeError): pass # Ignore if years cannot be compared
+            if search_cache is not None:
+                results = search_cache.get((query, search_types), lambda: _fetch_trakt_search_results(query, search_types, trakt_client))
+            else:
+                results = _fetch_trakt_search_results(query, search_types, trakt_client)
+            results = [r for r in results if r.get(r.get('type'), {}).get('ids', {}).get('trakt')]
+            if not results: continue # Nothing found, try next title variation if available
 
-                # Return the first result, assuming Trakt's relevance sorting is good enough
-                return results[0]
+            scored = [(_score_search_candidate(r, i, known_titles, year, trakt_type), i) for i, r in enumerate(results)]
+            best_score, best_index = max(scored, key=lambda candidate: (candidate[0], -candidate[1]))
+            if best_score >= TRAKT_MATCH_MIN_SCORE: return results[best_index]
+            # None of the candidates is close enough, try next title variation if available
 
         except requests.exceptions.Timeout:
-            tqdm.write(f"Warning: Timeout searching Trakt by title: '{normalized_title}' (Source ID: {source_id_logging})")
+            tqdm.write(f"Warning: Timeout searching Trakt by title: '{query}' (Source ID: {source_id_logging})")
+            search_failed = True
         except requests.exceptions.RequestException as e:
-             # Log non-404 errors
-             if response is None or response.status_code != 404:
-                status_code = getattr(response, 'status_code', 'N/A')
-                error_text = getattr(response, 'text', 'No response text')[:150]
-                tqdm.write(f"Warning: Trakt title search failed ('{normalized_title}', Source ID: {source_id_logging}, Type: {trakt_type}): {e} - Status: {status_code}")
+            status_code = getattr(e.response, 'status_code', 'N/A')
+            tqdm.write(f"Warning: Trakt title search failed ('{query}', Source ID: {source_id_logging}, Type: {search_types}): {e} - Status: {status_code}")
+            search_failed = True
         except json.JSONDecodeError:
-             tqdm.write(f"Warning: Error decoding Trakt title search response for '{normalized_title}'. Content: {getattr(response, 'text', 'N/A')[:150]}")
+             tqdm.write(f"Warning: Error decoding Trakt title search response for '{query}'.")
+             search_failed = True
         except Exception as e: # Catch unexpected errors during processing
-            tqdm.write(f"Unexpected error during title search for '{title}' (Source ID: {source_id_logging}): {e}")
+            tqdm.write(f"Unexpected error during title search for '{query}' (Source ID: {source_id_logging}): {e}")
+            search_failed = True
+
+    # If loop finishes without returning a result; a failed search can't tell that the title is missing on Trakt
+    return TRAKT_SEARCH_FAILED if search_failed else None
+
+# --- Offline ID Mapping (MAL/AniList -> TVDB/TMDB/IMDb) ---
+# The mapping file is indexed into SQLite once per file version, so lookups don't keep the JSON in memory.
+
+def refresh_id_mapping_file():
+    """Returns the local mapping file path, downloading it from ID_MAPPING_URL first if missing or stale."""
+    if not ID_MAPPING_FILE and not ID_MAPPING_URL: return None
+    mapping_file = _state_file_path(ID_MAPPING_FILE, "anime-list-full.json")
+    if ID_MAPPING_URL:
+        stale = not os.path.exists(mapping_file) or time.time() - os.path.getmtime(mapping_file) > ID_MAPPING_REFRESH_DAYS * 86400
+        if stale:
+            print(f"Downloading anime ID mapping from {ID_MAPPING_URL}...")
+            try:
+                response = ID_MAPPING_CLIENT.get(ID_MAPPING_URL, timeout=60, stream=True)
+                response.raise_for_status()
+                with open(mapping_file + ".tmp", 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=65536): f.write(chunk)
+                os.replace(mapping_file + ".tmp", mapping_file)
+            except (requests.exceptions.RequestException, IOError) as e:
+                print(f"Warning: Could not download anime ID mapping: {e}. Using existing copy if available.")
+    return mapping_file if os.path.exists(mapping_file) else None
+
+def _first_mapping_value(value):
+    """Mapping files hold IDs as int, str or list; returns the first usable one as int (or str for IMDb)."""
+    if isinstance(value, list): value = value[0] if value else None
+    if value in (None, ""): return None
+    if isinstance(value, str) and value.startswith("tt"): return value
+    try: return int(value)
+    except (ValueError, TypeError): return None
+
+def open_id_mapping_index():
+    """Opens the SQLite ID mapping index, rebuilding it when the mapping file changed. Returns a connection or None."""
+    mapping_file = refresh_id_mapping_file()
+    if not mapping_file: return None
+    index_file = _state_file_path(None, "anime_id_mapping.sqlite3")
+    signature = f"{os.path.getsize(mapping_file)}:{os.path.getmtime(mapping_file)}"
+    try:
+        conn = sqlite3.connect(index_file, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS id_mapping (
+                source TEXT NOT NULL, source_id INTEGER NOT NULL,
+                tvdb_id INTEGER, tmdb_id INTEGER, imdb_id TEXT,
+                PRIMARY KEY (source, source_id)
+            )""")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row and row[0] == signature: return conn
+
+        print(f"Indexing anime ID mapping file {mapping_file}...")
+        with open(mapping_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict): data = data.get('data', [])
+        rows = []
+        for item in data:
+            tvdb_id = _first_mapping_value(item.get('thetvdb_id') or item.get('tvdb_id'))
+            tmdb_id = _first_mapping_value(item.get('themoviedb_id') or item.get('tmdb_id'))
+            imdb_id = _first_mapping_value(item.get('imdb_id'))
+            if not isinstance(imdb_id, str): imdb_id = None
+            if not (tvdb_id or tmdb_id or imdb_id): continue
+            for source, key in (("MAL", "mal_id"), ("AniList", "anilist_id")):
+                source_id = _first_mapping_value(item.get(key))
+                if isinstance(source_id, int): rows.append((source, source_id, tvdb_id, tmdb_id, imdb_id))
+        del data
+        conn.execute("DELETE FROM id_mapping")
+        conn.executemany("INSERT OR REPLACE INTO id_mapping VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+        conn.commit()
+        print(f"Indexed {len(rows)} MAL/AniList ID mappings.")
+        return conn
+    except (sqlite3.Error, IOError, json.JSONDecodeError, AttributeError) as e:
+        print(f"Warning: Could not load anime ID mapping {mapping_file}: {e}. Falling back to title search only.")
+        return None
+
+def lookup_mapped_ids(conn, source, source_id):
+    """Returns {'tvdb': .., 'tmdb': .., 'imdb': ..} (non-empty values only) for a source ID, or None."""
+    if conn is None or source_id is None: return None
+    try:
+        row = conn.execute("SELECT tvdb_id, tmdb_id, imdb_id FROM id_mapping WHERE source = ? AND source_id = ?",
+                           (source, int(source_id))).fetchone()
+    except (sqlite3.Error, ValueError, TypeError):
+        return None
+    if not row: return None
+    return {k: v for k, v in zip(("tvdb", "tmdb", "imdb"), row) if v}
+
+def find_trakt_match_by_ids(mapped_ids, media_format, trakt_client):
+    """Looks up a Trakt item by exact external ID (/search/:id_type/:id). Returns a search result or None."""
+    trakt_type = get_trakt_type_for_format(media_format)
+    if not trakt_type or not mapped_ids: return None
+    # TVDB only catalogues shows; TMDB IDs in the mapping are movie IDs for movies
+    id_order = ("tvdb", "imdb") if trakt_type == "show" else ("tmdb", "imdb")
+    for id_type in id_order:
+        if id_type not in mapped_ids: continue
+        response = None
+        try:
+            response = trakt_client.get(f"{TRAKT_API_URL}/search/{id_type}/{mapped_ids[id_type]}", params={"type": trakt_type}, timeout=15)
+            if response.status_code == 404: continue
+            response.raise_for_status()
+            for result in response.json():
+                if result.get(trakt_type, {}).get('ids', {}).get('trakt'): return result
+        except requests.exceptions.RequestException as e:
+            tqdm.write(f"Warning: Trakt ID lookup failed ({id_type} {mapped_ids[id_type]}): {e} - Status: {getattr(response, 'status_code', 'N/A')}")
+        except json.JSONDecodeError:
+            tqdm.write(f"Warning: Error decoding Trakt ID lookup response for {id_type} {mapped_ids[id_type]}.")
+    return None
+
+def find_trakt_match(title_main, title_english, source_id, year, media_format, trakt_client, mapped_ids=None, alt_titles=(),
+                     search_cache=None):
+    """
+    Resolves a source entry on Trakt: exact ID lookup when the offline mapping knows the entry,
+    title/year search otherwise. Returns (search result or None, matched_by_id); the result is
+    TRAKT_SEARCH_FAILED if Trakt could not be searched.
+    """
+    if mapped_ids:
+        trakt_match = find_trakt_match_by_ids(mapped_ids, media_format, trakt_client)
+        if trakt_match: return trakt_match, True
+    return search_trakt(title_main, title_english, source_id, year, media_format, trakt_client, alt_titles, search_cache), False
+
+# --- Trakt Match Cache ---
+# Maps (source, source ID, media format) to the Trakt item found by search_trakt, so reruns
+# don't have to search again. Manual overrides are stored with media_format '*' and never expire.
+
+def open_match_cache():
+    """Opens (and creates if needed) the SQLite match cache. Returns a connection or None."""
+    cache_file = _state_file_path(TRAKT_MATCH_CACHE_FILE, "trakt_match_cache.sqlite3")
+    try:
+        conn = sqlite3.connect(cache_file, timeout=30, check_same_thread=False) # Daemon cycles may reuse it on another thread
+        conn.execute("PRAGMA journal_mode=WAL") # Accounts synced in parallel read and write the same cache
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trakt_matches (
+                source TEXT NOT NULL, source_id TEXT NOT NULL, media_format TEXT NOT NULL,
+                trakt_type TEXT NOT NULL, trakt_ids TEXT NOT NULL, title TEXT, year INTEGER,
+                matched_at REAL NOT NULL, is_override INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, source_id, media_format)
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trakt_misses (
+                source TEXT NOT NULL, username TEXT NOT NULL, source_id TEXT NOT NULL,
+                title TEXT, entry TEXT NOT NULL, attempts INTEGER NOT NULL, retry_at REAL NOT NULL,
+                PRIMARY KEY (source, username, source_id)
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trakt_show_seasons (
+                trakt_id INTEGER PRIMARY KEY, etag TEXT, seasons TEXT NOT NULL, fetched_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS anime_relations (
+                source TEXT NOT NULL, source_id TEXT NOT NULL, format TEXT, year INTEGER,
+                prequels TEXT NOT NULL, fetched_at REAL NOT NULL,
+                PRIMARY KEY (source, source_id)
+            )""")
+        conn.commit()
+        return conn
+    except sqlite3.Error as e:
+        print(f"Warning: Could not open Trakt match cache {cache_file}: {e}. Continuing without cache.")
+        return None
 
-    # If loop finishes without returning a result
+def get_cached_trakt_match(conn, source, source_id, media_format):
+    """Returns a cached match in search_trakt's result shape, or None if missing or expired."""
+    if conn is None or source_id is None or not media_format: return None
+    try:
+        row = conn.execute(
+            "SELECT trakt_type, trakt_ids, title, year, matched_at, is_override FROM trakt_matches "
+            "WHERE source = ? AND source_id = ? AND media_format IN (?, '*') ORDER BY is_override DESC LIMIT 1",
+            (source, str(source_id), media_format.lower())).fetchone()
+    except sqlite3.Error as e:
+        tqdm.write(f"Warning: Match cache lookup failed for {source} ID {source_id}: {e}")
+        return None
+    if not row: return None
+    trakt_type, trakt_ids, title, year, matched_at, is_override = row
+    # Expired automatic matches are re-validated by searching again
+    if not is_override and time.time() - matched_at > MATCH_CACHE_TTL_DAYS * 86400:
+        return None
+    return {"type": trakt_type, trakt_type: {"title": title, "year": year, "ids": json.loads(trakt_ids)}}
+
+def store_trakt_match(conn, source, source_id, media_format, trakt_match):
+    """Stores a search_trakt result in the match cache."""
+    if conn is None or source_id is None or not media_format or not trakt_match: return
+    trakt_type = "show" if trakt_match.get('show') else "movie" if trakt_match.get('movie') else None
+    item_data = trakt_match.get(trakt_type) if trakt_type else None
+    if not item_data or not item_data.get('ids', {}).get('trakt'): return
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO trakt_matches "
+            "(source, source_id, media_format, trakt_type, trakt_ids, title, year, matched_at, is_override) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            (source, str(source_id), media_format.lower(), trakt_type, json.dumps(item_data['ids']),
+             item_data.get('title'), item_data.get('year'), time.time()))
+        conn.execute("DELETE FROM trakt_misses WHERE source = ? AND source_id = ?", (source, str(source_id)))
+        conn.commit()
+    except sqlite3.Error as e:
+        tqdm.write(f"Warning: Could not store match for {source} ID {source_id} in cache: {e}")
+
+def invalidate_trakt_match(conn, source, source_id):
+    """Removes all cached matches (including overrides) for a source ID. Returns rows removed."""
+    if conn is None: return 0
+    cursor = conn.execute("DELETE FROM trakt_matches WHERE source = ? AND source_id = ?", (source, str(source_id)))
+    conn.execute("DELETE FROM trakt_misses WHERE source = ? AND source_id = ?", (source, str(source_id)))
+    conn.commit()
+    return cursor.rowcount
+
+def override_trakt_match(conn, source, source_id, trakt_type, trakt_id):
+    """
+    Pins a source ID to a specific Trakt show/movie ID, regardless of media format.
+    Raises ValueError for a non-numeric Trakt ID (before the stored match is touched).
+    """
+    if conn is None: return False
+    if trakt_type not in ("show", "movie"):
+        print(f"Error: Trakt type must be 'show' or 'movie', got '{trakt_type}'.")
+        return False
+    trakt_id = int(trakt_id) # Validate before invalidating the current match
+    invalidate_trakt_match(conn, source, source_id)
+    conn.execute(
+        "INSERT INTO trakt_matches "
+        "(source, source_id, media_format, trakt_type, trakt_ids, title, year, matched_at, is_override) "
+        "VALUES (?, ?, '*', ?, ?, NULL, NULL, ?, 1)",
+        (source, str(source_id), trakt_type, json.dumps({"trakt": trakt_id}), time.time()))
+    conn.commit()
+    return True
+
+# --- Unmatched Entries (negative cache) ---
+# Entries Trakt search found nothing for are kept per user with the time of their next search, backing off
+# through MATCH_MISS_RETRY_DAYS. Their extracted fields are stored too: incremental runs don't fetch unchanged
+# entries again, so due entries are queued from here instead.
+
+def get_trakt_miss_retry_at(conn, source, username, source_id):
+    """Returns when an unmatched entry may be searched again (epoch seconds), or None if it isn't backing off."""
+    if conn is None or source_id is None: return None
+    try:
+        row = conn.execute("SELECT retry_at FROM trakt_misses WHERE source = ? AND username = ? AND source_id = ?",
+                           (source, username, str(source_id))).fetchone()
+    except sqlite3.Error as e:
+        tqdm.write(f"Warning: Unmatched entry lookup failed for {source} ID {source_id}: {e}")
+        return None
+    return row[0] if row and row[0] > time.time() else None
+
+def record_trakt_miss(conn, source, username, source_entry):
+    """Records a SourceEntry Trakt search found nothing for."""
+    if conn is None: return
+    source_id, display_title = str(source_entry.source_id), source_entry.display_title
+    try:
+        row = conn.execute("SELECT attempts FROM trakt_misses WHERE source = ? AND username = ? AND source_id = ?",
+                           (source, username, source_id)).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        retry_days = MATCH_MISS_RETRY_DAYS[min(attempts, len(MATCH_MISS_RETRY_DAYS)) - 1]
+        conn.execute("INSERT OR REPLACE INTO trakt_misses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (source, username, source_id, display_title, json.dumps(source_entry._asdict()), attempts,
+                      time.time() + retry_days * 86400))
+        conn.commit()
+    except sqlite3.Error as e:
+        tqdm.write(f"Warning: Could not record unmatched {source} ID {source_id}: {e}")
+
+def load_due_trakt_misses(conn, source, username):
+    """Returns the SourceEntry records of unmatched entries whose next search is due."""
+    if conn is None: return []
+    try:
+        rows = conn.execute("SELECT entry FROM trakt_misses WHERE source = ? AND username = ? AND retry_at <= ?",
+                            (source, username, time.time())).fetchall()
+    except sqlite3.Error as e:
+        print(f"Warning: Could not load unmatched entries to retry: {e}")
+        return []
+    return [SourceEntry(**{**fields, "alt_titles": tuple(fields.get("alt_titles") or ())})
+            for fields in (json.loads(row[0]) for row in rows)]
+
+# --- Franchise Seasons (FRANCHISE_SEASONS) ---
+# AniList and MAL list every season as its own entry. Following AniList PREQUEL relations between TV
+# entries gives each entry's season number and the franchise's first season (root), so a franchise
+# is looked up on Trakt once and history is sent per season. Relations are cached in the match cache
+# database, keyed by source ID (MAL IDs for MAL lists), including IDs AniList doesn't know.
+
+FRANCHISE_TV_FORMATS = ["TV", "TV_SHORT"]
+
+def fetch_anilist_relations(source, source_ids):
+    """
+    Fetches format, start year and PREQUEL relations for up to ANILIST_RELATIONS_BATCH_SIZE media.
+    Returns {source_id: {"format", "year", "prequels"}} (IDs as strings), or None if the request failed.
+    """
+    id_filter = "idMal_in" if source == "MAL" else "id_in"
+    query = """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            media (%s: $ids, type: ANIME) {
+                id idMal format startDate { year }
+                relations { edges { relationType node { id idMal type } } }
+            }
+        }
+    }""" % id_filter
+    variables = {"ids": [int(i) for i in source_ids], "perPage": ANILIST_RELATIONS_BATCH_SIZE}
+    response = None
+    try:
+        response = ANILIST_CLIENT.post(ANILIST_API_URL, json={'query': query, 'variables': variables}, timeout=30)
+        response.raise_for_status()
+        data = response.json()
+        if "errors" in data and data["errors"]:
+            tqdm.write(f"AniList API Error while fetching relations: {data['errors']}")
+            return None
+        id_key = "idMal" if source == "MAL" else "id"
+        relations = {}
+        for media in ((data.get('data') or {}).get('Page') or {}).get('media') or []:
+            if not media.get(id_key): continue
+            prequels = [str(edge['node'][id_key]) for edge in (media.get('relations') or {}).get('edges') or []
+                        if edge.get('relationType') == 'PREQUEL' and (edge.get('node') or {}).get('type') == 'ANIME'
+                        and edge['node'].get(id_key)]
+            relations[str(media[id_key])] = {"format": media.get('format'), "year": (media.get('startDate') or {}).get('year'),
+                                             "prequels": prequels}
+        return relations
+    except requests.exceptions.RequestException as e:
+        tqdm.write(f"Warning: Could not fetch AniList relations: {e} - Status: {getattr(response, 'status_code', 'N/A')}")
+    except (json.JSONDecodeError, KeyError, ValueError, TypeError) as e:
+        tqdm.write(f"Warning: Could not read AniList relations response: {e}")
     return None
 
+def load_franchise_relations(conn, source, source_ids, relations):
+    """
+    Adds the relations of source_ids and their prequels (up to FRANCHISE_MAX_DEPTH steps) to the
+    relations dict: from the cache first, the rest from AniList in batches (then cached).
+    """
+    wanted = {str(i) for i in source_ids if i is not None} - set(relations)
+    for _depth in range(FRANCHISE_MAX_DEPTH):
+        if not wanted: break
+        missing = sorted(wanted)
+        if conn is not None:
+            try:
+                for start in range(0, len(missing), 500): # Stay below SQLite's bound parameter limit
+                    batch = missing[start:start + 500]
+                    for source_id, media_format, year, prequels in conn.execute(
+                            f"SELECT source_id, format, year, prequels FROM anime_relations WHERE source = ? AND fetched_at > ? "
+                            f"AND source_id IN ({','.join('?' * len(batch))})", (source, time.time() - RELATIONS_CACHE_TTL_DAYS * 86400, *batch)):
+                        relations[source_id] = {"format": media_format, "year": year, "prequels": json.loads(prequels)}
+            except sqlite3.Error as e:
+                tqdm.write(f"Warning: Relations cache lookup failed: {e}")
+        missing = [i for i in missing if i not in relations]
+        for start in range(0, len(missing), ANILIST_RELATIONS_BATCH_SIZE):
+            batch = missing[start:start + ANILIST_RELATIONS_BATCH_SIZE]
+            fetched = fetch_anilist_relations(source, batch)
+            if fetched is None: continue # Not cached, so the next run asks again
+            for source_id in batch: # IDs AniList doesn't know are cached as standalone entries
+                relations[source_id] = fetched.get(source_id) or {"format": None, "year": None, "prequels": []}
+            if conn is not None:
+                try:
+                    conn.executemany("INSERT OR REPLACE INTO anime_relations VALUES (?, ?, ?, ?, ?, ?)",
+                                     [(source, i, relations[i]['format'], relations[i]['year'], json.dumps(relations[i]['prequels']),
+                                       time.time()) for i in batch])
+                    conn.commit()
+                except sqlite3.Error as e:
+                    tqdm.write(f"Warning: Could not cache relations: {e}")
+        wanted = {p for i in wanted if i in relations for p in relations[i]['prequels']} - set(relations)
+
+def get_franchise_season(relations, source_id):
+    """
+    Returns (root_id, season_number, root_year) for a TV entry: the number of TV entries along its
+    PREQUEL chain (itself included) and the first one of them. Returns None for other formats or unknown entries.
+    """
+    node = str(source_id)
+    if (relations.get(node) or {}).get('format') not in FRANCHISE_TV_FORMATS: return None
+    root = node; season = 1; seen = {node}
+    for _step in range(FRANCHISE_MAX_DEPTH):
+        prequels = [p for p in relations[node]['prequels'] if p in relations and p not in seen]
+        if not prequels: break
+        # Follow the TV prequel if there is one (movies/OVAs in between don't count as seasons)
+        node = next((p for p in prequels if relations[p]['format'] in FRANCHISE_TV_FORMATS), prequels[0])
+        seen.add(node)
+        if relations[node]['format'] in FRANCHISE_TV_FORMATS: root = node; season += 1
+    return root, season, relations[root].get('year')
+
 # --- Date/Score Formatting ---
 
 def format_anilist_date_to_iso(anilist_date):
@@ -504,14 +1744,16 @@ def convert_mal_score_to_rating(mal_score):
 
 
 # --- Trakt Sync Batch Sending ---
-def _send_trakt_sync_batch(endpoint, payload_key, items, access_token):
-    """Generic function to send a batch to a Trakt sync endpoint."""
+def _send_trakt_sync_batch(endpoint, payload_key, items, trakt_client, batch_size=None):
+    """Generic function to send a batch to a Trakt sync endpoint. batch_size (AdaptiveBatchSize) is told how it went."""
     if not items: return True, 0
     url = f"{TRAKT_API_URL}/{endpoint}"
-    auth_headers = {**TRAKT_HEADERS, "Authorization": f"Bearer {access_token}"}
     payload = {"shows": [], "movies": []}
     items_to_send_shows = []
     items_to_send_movies = []
+    season_shows = {} # Trakt ID -> show entry with a seasons list (FRANCHISE_SEASONS)
+    items_to_send_episodes = [] # Episodes of watching entries (SYNC_WATCHING_PROGRESS), many shows per batch
+    episode_item_count = 0
     expected_item_count = 0
 
     # Prepare items and validate required fields
@@ -525,7 +1767,17 @@ def _send_trakt_sync_batch(endpoint, payload_key, items, access_token):
             if not item.get("watched_at"):
                  tqdm.write(f"Warning: Skipping history item due to missing watched_at: {item.get('title', 'Unknown Title')}")
                  continue
+            if item.get("episodes"): # Watching entry or partly watched show: only these episodes (by episode Trakt ID)
+                items_to_send_episodes.extend({"watched_at": item["watched_at"], "ids": {"trakt": episode_id}} for episode_id in item["episodes"])
+                episode_item_count += 1; expected_item_count += 1
+                continue
             entry = {"watched_at": item["watched_at"], "ids": item["trakt_ids"]}
+            if item.get("season") and item["type"] == "show": # Franchise seasons: only this season is marked watched
+                entry = {"ids": item["trakt_ids"], "seasons": [{"number": item["season"], "watched_at": item["watched_at"]}]}
+                if item["trakt_ids"].get("trakt") in season_shows: # Another season of a show already in this batch
+                    season_shows[item["trakt_ids"]["trakt"]]["seasons"].extend(entry["seasons"]); expected_item_count += 1
+                    continue
+                season_shows[item["trakt_ids"].get("trakt")] = entry
 
         elif endpoint == "sync/ratings":
             if item.get("rating") is None:
@@ -547,15 +1799,21 @@ def _send_trakt_sync_batch(endpoint, payload_key, items, access_token):
 
     payload["shows"] = items_to_send_shows
     payload["movies"] = items_to_send_movies
+    if items_to_send_episodes: payload["episodes"] = items_to_send_episodes
 
     # Skip API call if no valid items were prepared
-    if not payload["shows"] and not payload["movies"]:
+    if not payload["shows"] and not payload["movies"] and not items_to_send_episodes:
         # tqdm.write(f"Info: No valid items to send in {payload_key.upper()} batch.")
         return True, 0
 
-    # Make the API call to Trakt
+    # Make the API call to Trakt (HTTP 429 is retried by the client)
+    response = None
+    payload_bytes = len(json.dumps(payload))
     try:
-        response = requests.post(url, headers=auth_headers, json=payload, timeout=30)
+        response = trakt_client.post(url, json=payload, timeout=30)
+        if batch_size is not None:
+            batch_size.observe(response.elapsed.total_seconds(), payload_bytes,
+                               getattr(response, 'attempts', 1) > 1, failed=not response.ok)
         response_data = {}
         try: response_data = response.json() # Try to parse JSON even on error for details
         except json.JSONDecodeError: pass
@@ -569,8 +1827,8 @@ def _send_trakt_sync_batch(endpoint, payload_key, items, access_token):
             # History adds episodes for shows, movies directly.
             # Count movies added + estimate shows added based on if any episodes were added.
             synced_count = added_section.get('movies', 0)
-            if len(items_to_send_shows) > 0 and added_section.get('episodes', 0) > 0:
-                 synced_count += len(items_to_send_shows) # Approx count for shows added
+            if (items_to_send_shows or items_to_send_episodes) and added_section.get('episodes', 0) > 0:
+                 synced_count += episode_item_count + sum(1 + max(0, len(e.get('seasons', [])) - 1) for e in items_to_send_shows) # Approx count
         elif endpoint == "sync/ratings":
             synced_count = added_section.get('shows', 0) + added_section.get('movies', 0)
 
@@ -584,90 +1842,172 @@ def _send_trakt_sync_batch(endpoint, payload_key, items, access_token):
 
     except requests.exceptions.Timeout:
         print(f"\nError: Timeout adding {payload_key.upper()} batch to Trakt ({endpoint})")
+        if batch_size is not None: batch_size.observe(30, payload_bytes, False, failed=True)
         return False, 0
     except requests.exceptions.RequestException as e:
         error_content = getattr(response, 'text', 'No response text')
         print(f"\nError adding {payload_key.upper()} batch to Trakt ({endpoint}): {e}")
         print(f"Response status: {getattr(response, 'status_code', 'N/A')}, Content sample: {error_content[:500]}")
-        # Handle rate limiting with retry
-        if response is not None and response.status_code == 429:
-            retry_after = int(response.headers.get('Retry-After', 15)) # Default 15s
-            print(f"Rate limited. Waiting {retry_after}s before retrying {payload_key.upper()}...")
-            time.sleep(retry_after)
-            # Retry ONCE
-            try:
-                response_retry = requests.post(url, headers=auth_headers, json=payload, timeout=45)
-                response_retry.raise_for_status()
-                # Re-parse count on retry success
-                response_data_retry = response_retry.json()
-                synced_count_retry = 0
-                added_section_retry = response_data_retry.get('added', {})
-                if endpoint == "sync/history":
-                     synced_count_retry = added_section_retry.get('movies', 0)
-                     if len(items_to_send_shows) > 0 and added_section_retry.get('episodes', 0) > 0:
-                          synced_count_retry += len(items_to_send_shows)
-                elif endpoint == "sync/ratings":
-                     synced_count_retry = added_section_retry.get('shows', 0) + added_section_retry.get('movies', 0)
-                print(f"Retry successful. Synced approx {synced_count_retry} items.")
-                return True, synced_count_retry # Return actual count from successful retry
-            except Exception as e2:
-                 error_content_retry = getattr(response_retry, 'text', 'No response text')
-                 print(f"Error on retry adding {payload_key.upper()} batch: {e2}")
-                 print(f"Retry Response: {getattr(response_retry, 'status_code', 'N/A')} {error_content_retry[:500]}")
-                 return False, 0 # Failed even after retry
-        return False, 0 # General failure
+        return False, 0 # General failure (including HTTP 429 after all retries)
     except json.JSONDecodeError: # Fallback if JSON parsing failed earlier
         print(f"Error decoding Trakt {payload_key} response. Content: {getattr(response, 'text', 'N/A')[:500]}")
         return False, 0
 
 
-def add_to_trakt_history(items_to_add, access_token):
+def add_to_trakt_history(items_to_add, trakt_client, batch_size=None):
     """Adds batch to Trakt watched history. Returns success bool, count added."""
-    return _send_trakt_sync_batch("sync/history", "history", items_to_add, access_token)
+    return _send_trakt_sync_batch("sync/history", "history", items_to_add, trakt_client, batch_size)
 
-def add_to_trakt_ratings(items_to_rate, access_token):
+def add_to_trakt_ratings(items_to_rate, trakt_client, batch_size=None):
     """Adds batch to Trakt ratings. Returns success bool, count added."""
-    return _send_trakt_sync_batch("sync/ratings", "ratings", items_to_rate, access_token)
+    return _send_trakt_sync_batch("sync/ratings", "ratings", items_to_rate, trakt_client, batch_size)
+
+
+class AdaptiveBatchSize:
+    """
+    Number of items per Trakt sync batch. Grows by a quarter while batches are answered quickly,
+    halves after a slow response, an oversized payload, HTTP 429 or a failed batch.
+    """
+    def __init__(self, initial=BATCH_SIZE, minimum=TRAKT_BATCH_MIN_SIZE, maximum=TRAKT_BATCH_MAX_SIZE):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(self.maximum, max(self.minimum, initial))
+        self.lock = threading.Lock()
+
+    def observe(self, latency, payload_bytes, rate_limited, failed=False):
+        """Adjusts the size after one batch: latency in seconds, payload size in bytes."""
+        with self.lock:
+            if failed or rate_limited or latency > TRAKT_BATCH_TARGET_SECONDS or payload_bytes > TRAKT_BATCH_MAX_BYTES:
+                self.size = max(self.minimum, self.size // 2)
+            elif latency < TRAKT_BATCH_TARGET_SECONDS / 2 and payload_bytes < TRAKT_BATCH_MAX_BYTES / 2:
+                self.size = min(self.maximum, self.size + max(1, self.size // 4))
+
+
+_WRITER_DONE = object()
+
+class TraktBatchWriter:
+    """
+    Writer stage between the search loop and Trakt: history/rating items are queued with add() and posted
+    by a background thread, so searching never waits on a batch in flight. History and ratings batches are
+    sent concurrently (one per endpoint at a time, paced by the client's POST budget).
+    Results are collected in stats (history_synced, ratings_synced, failed_*_batches) and synced.
+    """
+    KINDS = {"history": add_to_trakt_history, "ratings": add_to_trakt_ratings}
+
+    def __init__(self, trakt_client, journal=None):
+        self.trakt_client = trakt_client
+        self.journal = journal
+        self.batch_size = AdaptiveBatchSize()
+        self.stats = collections.Counter()
+        self.synced = {kind: [] for kind in self.KINDS} # Library entries acknowledged by Trakt (_batch_library_entries)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max(1, WRITE_QUEUE_SIZE))
+        self.executor = ThreadPoolExecutor(max_workers=len(self.KINDS))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, kind, item):
+        """Queues one item for the 'history' or 'ratings' batch (blocks while the queue is full)."""
+        self.queue.put((kind, item))
+
+    def close(self):
+        """Sends the remaining items and waits for every batch to finish."""
+        self.queue.put(_WRITER_DONE)
+        self.thread.join()
+        self.executor.shutdown()
+
+    def _run(self):
+        batches = {kind: [] for kind in self.KINDS}
+        in_flight = {} # kind -> future of the batch being sent
+        while True:
+            message = self.queue.get()
+            finished = message is _WRITER_DONE
+            if not finished:
+                kind, item = message
+                batches[kind].append(item)
+            for kind, items in batches.items():
+                if not items or not (finished or len(items) >= self.batch_size.size): continue
+                if kind in in_flight: in_flight.pop(kind).result() # Keep one batch per endpoint in flight
+                in_flight[kind] = self.executor.submit(self._send, kind, items, "final " if finished else "")
+                batches[kind] = []
+            if finished: break
+        for future in in_flight.values(): future.result()
+
+    def _send(self, kind, items, label):
+        tqdm.write(f"\nAdding {label}{kind.upper()} batch ({len(items)} items)...")
+        try:
+            success, count_synced = self.KINDS[kind](items, self.trakt_client, self.batch_size)
+        except Exception as e: # Keep the writer alive; the batch counts as failed
+            tqdm.write(f"Error sending {kind.upper()} batch to Trakt: {e}")
+            success, count_synced = False, 0
+        with self.lock:
+            if success:
+                self.stats[f'{kind}_synced'] += count_synced
+                self.synced[kind].extend(_batch_library_entries(kind, items))
+            else: self.stats[f'failed_{kind}_batches'] += 1
+        if success and self.journal is not None:
+            self.journal.record_batch(kind, [item['source_id'] for item in items])
 
 
 # --- Trakt Existing Data Fetching ---
-def _get_trakt_sync_ids(endpoint, access_token):
-    """Fetches all Trakt IDs for a given sync endpoint (watched or ratings)."""
-    ids = set()
-    # Request a large limit, Trakt might cap it but worth asking.
-    url = f"{TRAKT_API_URL}/{endpoint}?limit=10000"
-    auth_headers = {**TRAKT_HEADERS, "Authorization": f"Bearer {access_token}"}
+def _get_trakt_sync_ids(endpoint, trakt_client, with_seasons=False):
+    """
+    Fetches all Trakt IDs for a given sync endpoint (watched or ratings) as a TraktLibraryIndex, with the
+    current rating of every item for ratings.
+    Reads the list page by page (X-Pagination-Page-Count) and keeps only the IDs and ratings,
+    so memory doesn't grow with the size of each page's JSON.
+    Returns (index, season_index); with_seasons also indexes every watched season (FRANCHISE_SEASONS).
+    """
+    rated = endpoint.startswith("sync/ratings")
+    items = []; season_keys = []
+    params = {"limit": TRAKT_SYNC_PAGE_LIMIT}
+    # Watched shows would otherwise include every season and episode played
+    if endpoint == "sync/watched/shows" and not with_seasons: params["extended"] = "noseasons"
+    url = f"{TRAKT_API_URL}/{endpoint}"
+    response = None
+    page = 1
     try:
-        response = requests.get(url, headers=auth_headers, timeout=45) # Increase timeout for potentially large lists
-        response.raise_for_status()
-        data = response.json()
-        # Ensure response is a list as expected
-        if not isinstance(data, list):
-             print(f"Error: Unexpected response format from {endpoint}. Expected a list.")
-             print(f"Content sample: {str(data)[:500]}")
-             return None
-
-        # Extract Trakt IDs based on the endpoint's structure
-        for item in data:
-            item_type = None
-            ids_obj = None
-            # /sync/watched response structure
-            if endpoint.startswith("sync/watched"):
-                 if 'show' in item and item['show']: item_type = 'show'; ids_obj = item.get('show', {}).get('ids')
-                 elif 'movie' in item and item['movie']: item_type = 'movie'; ids_obj = item.get('movie', {}).get('ids')
-            # /sync/ratings response structure
-            elif endpoint.startswith("sync/ratings"):
-                 item_key = item.get('type') # 'show' or 'movie'
-                 if item_key and item_key in item and item[item_key]:
-                     item_type = item_key
-                     ids_obj = item.get(item_key, {}).get('ids')
-
-            # Add the composite ID (e.g., "show_12345") to the set
-            if item_type and ids_obj and ids_obj.get('trakt'):
-                trakt_id = ids_obj['trakt']
-                ids.add(f"{item_type}_{trakt_id}")
-
-        return ids
+        while True:
+            params["page"] = page
+            response = trakt_client.get(url, params=params, timeout=45) # Increase timeout for potentially large lists
+            response.raise_for_status()
+            data = response.json()
+            # Ensure response is a list as expected
+            if not isinstance(data, list):
+                 print(f"Error: Unexpected response format from {endpoint}. Expected a list.")
+                 print(f"Content sample: {str(data)[:500]}")
+                 return None
+
+            # Extract Trakt IDs based on the endpoint's structure
+            for item in data:
+                item_type = None
+                ids_obj = None
+                # /sync/watched response structure
+                if endpoint.startswith("sync/watched"):
+                     if 'show' in item and item['show']: item_type = 'show'; ids_obj = item.get('show', {}).get('ids')
+                     elif 'movie' in item and item['movie']: item_type = 'movie'; ids_obj = item.get('movie', {}).get('ids')
+                # /sync/ratings response structure
+                elif endpoint.startswith("sync/ratings"):
+                     item_key = item.get('type') # 'show' or 'movie'
+                     if item_key and item_key in item and item[item_key]:
+                         item_type = item_key
+                         ids_obj = item.get(item_key, {}).get('ids')
+
+                # Add the Trakt ID (with its rating) to the index
+                if item_type and ids_obj and ids_obj.get('trakt'):
+                    trakt_id = int(ids_obj['trakt'])
+                    items.append((trakt_id, item.get('rating') or 0) if rated else trakt_id)
+                    if with_seasons:
+                        season_keys.extend(_season_key(trakt_id, season['number']) for season in item.get('seasons') or []
+                                           if season.get('number') is not None)
+            del data # Release the page before fetching the next one
+
+            # Endpoints without pagination headers return everything in one response
+            page_count = response.headers.get('X-Pagination-Page-Count')
+            if not page_count or page >= int(page_count): break
+            page += 1
+
+        return TraktLibraryIndex(items, rated), (TraktLibraryIndex(season_keys) if with_seasons else None)
     except requests.exceptions.Timeout:
         print(f"Error: Timeout fetching existing Trakt data from {endpoint}")
         return None
@@ -675,35 +2015,264 @@ def _get_trakt_sync_ids(endpoint, access_token):
         print(f"Error fetching existing Trakt data from {endpoint}: {e}")
         if response is not None: print(f"Status: {response.status_code}, Text: {response.text[:500]}")
         return None # Indicate failure
+    except (json.JSONDecodeError, ValueError):
+        print(f"Error decoding Trakt response from {endpoint} (page {page}). Content: {response.text[:500]}")
+        return None
+
+def get_trakt_show_seasons(conn, trakt_client, trakt_id):
+    """
+    Returns a show's season/episode layout [[season_number, [[episode_number, episode_trakt_id], ...]], ...].
+    Cached in the match cache database; after SHOW_SEASONS_CACHE_DAYS it is revalidated with the stored ETag,
+    so an unchanged show costs a 304 instead of the whole structure. Returns None on failure.
+    """
+    row = None
+    if conn is not None:
+        try: row = conn.execute("SELECT etag, seasons, fetched_at FROM trakt_show_seasons WHERE trakt_id = ?", (int(trakt_id),)).fetchone()
+        except sqlite3.Error as e: tqdm.write(f"Warning: Season cache lookup failed for Trakt show {trakt_id}: {e}")
+    if row and time.time() - row[2] < SHOW_SEASONS_CACHE_DAYS * 86400:
+        return json.loads(row[1])
+
+    response = None
+    try:
+        headers = {"If-None-Match": row[0]} if row and row[0] else None
+        response = trakt_client.get(f"{TRAKT_API_URL}/shows/{trakt_id}/seasons", params={"extended": "episodes"},
+                                    headers=headers, timeout=30)
+        if response.status_code == 304 and row:
+            seasons = json.loads(row[1])
+        else:
+            response.raise_for_status()
+            seasons = [[season['number'], [[episode['number'], episode['ids']['trakt']] for episode in season.get('episodes') or []
+                                           if episode.get('number') is not None and episode.get('ids', {}).get('trakt')]]
+                       for season in response.json() if season.get('number') is not None]
+    except requests.exceptions.RequestException as e:
+        tqdm.write(f"Warning: Could not fetch seasons of Trakt show {trakt_id}: {e} - Status: {getattr(response, 'status_code', 'N/A')}")
+        return json.loads(row[1]) if row else None
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        tqdm.write(f"Warning: Could not read seasons of Trakt show {trakt_id}: {e}")
+        return json.loads(row[1]) if row else None
+    if conn is not None:
+        try:
+            conn.execute("INSERT OR REPLACE INTO trakt_show_seasons VALUES (?, ?, ?, ?)",
+                         (int(trakt_id), response.headers.get('ETag') or (row[0] if row else None), json.dumps(seasons), time.time()))
+            conn.commit()
+        except sqlite3.Error as e:
+            tqdm.write(f"Warning: Could not cache seasons of Trakt show {trakt_id}: {e}")
+    return seasons
+
+def get_trakt_watched_episodes(trakt_client, trakt_id):
+    """Returns the (season, episode) numbers the user already watched of a show (/progress/watched), or None on failure."""
+    response = None
+    try:
+        response = trakt_client.get(f"{TRAKT_API_URL}/shows/{trakt_id}/progress/watched",
+                                    params={"specials": "true", "count_specials": "false"}, timeout=15)
+        response.raise_for_status()
+        return {(season['number'], episode['number']) for season in response.json().get('seasons') or []
+                for episode in season.get('episodes') or [] if episode.get('completed')}
+    except requests.exceptions.RequestException as e:
+        tqdm.write(f"Warning: Could not fetch watched progress of Trakt show {trakt_id}: {e} - Status: {getattr(response, 'status_code', 'N/A')}")
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        tqdm.write(f"Warning: Could not read watched progress of Trakt show {trakt_id}: {e}")
+    return None
+
+def get_trakt_show_progress(conn, trakt_client, trakt_id):
+    """
+    Returns (season layout, watched (season, episode) numbers) of a show, which list progress is compared with,
+    or None if either could not be fetched.
+    """
+    seasons = get_trakt_show_seasons(conn, trakt_client, trakt_id)
+    watched = get_trakt_watched_episodes(trakt_client, trakt_id) if seasons else None
+    if seasons is None or watched is None: return None
+    return seasons, watched
+
+def select_progress_episodes(seasons, progress, season_number=None):
+    """
+    Returns [(season, episode, episode_trakt_id)] for the first `progress` episodes (all of them if None): of
+    season_number when the franchise season is known, otherwise counted across the regular seasons (specials
+    excluded) in order.
+    """
+    if season_number is not None: selected = [s for s in seasons if s[0] == season_number]
+    else: selected = sorted((s for s in seasons if s[0] > 0), key=lambda s: s[0])
+    episodes = [(season, number, episode_id) for season, season_episodes in selected for number, episode_id in sorted(season_episodes)]
+    return episodes if progress is None else episodes[:max(0, int(progress))]
+
+def get_trakt_last_activities(trakt_client):
+    """Fetches the user's /sync/last_activities timestamps. Returns a dict or None."""
+    response = None
+    try:
+        response = trakt_client.get(f"{TRAKT_API_URL}/sync/last_activities", timeout=15)
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        print(f"Warning: Could not fetch Trakt last activities: {e}. Refreshing the whole Trakt library.")
+        return None
     except json.JSONDecodeError:
-        print(f"Error decoding Trakt response from {endpoint}. Content: {response.text[:500]}")
+        print(f"Warning: Could not decode Trakt last activities. Content: {getattr(response, 'text', 'N/A')[:200]}")
         return None
 
-def get_trakt_watched_ids(access_token):
-    """Fetches all watched show and movie Trakt IDs."""
-    print("Fetching existing watched history from Trakt...")
-    watched_show_ids = _get_trakt_sync_ids("sync/watched/shows", access_token)
-    time.sleep(API_CALL_DELAY) # Delay between Trakt calls
-    watched_movie_ids = _get_trakt_sync_ids("sync/watched/movies", access_token)
-    # Check if either fetch failed
-    if watched_show_ids is None or watched_movie_ids is None: return None
-    # Combine the sets of IDs
-    all_watched_ids = watched_show_ids.union(watched_movie_ids)
-    print(f"Found {len(all_watched_ids)} existing watched items on Trakt.")
-    return all_watched_ids
-
-def get_trakt_rated_ids(access_token):
-    """Fetches all rated show and movie Trakt IDs."""
-    print("Fetching existing ratings from Trakt...")
-    rated_show_ids = _get_trakt_sync_ids("sync/ratings/shows", access_token)
-    time.sleep(API_CALL_DELAY) # Delay between Trakt calls
-    rated_movie_ids = _get_trakt_sync_ids("sync/ratings/movies", access_token)
-    # Check if either fetch failed
-    if rated_show_ids is None or rated_movie_ids is None: return None
-    # Combine the sets of IDs
-    all_rated_ids = rated_show_ids.union(rated_movie_ids)
-    print(f"Found {len(all_rated_ids)} existing rated items on Trakt.")
-    return all_rated_ids
+# --- Trakt Library Cache ---
+# The watched/rated items are cached on disk together with the /sync/last_activities timestamp of each
+# category. A category is only re-downloaded when Trakt reports newer activity for it (or the cache is
+# older than TRAKT_LIBRARY_MAX_AGE_DAYS, which also picks up removals that last_activities doesn't report).
+# Categories: (cache key, sync endpoint, last_activities section, last_activities field)
+TRAKT_LIBRARY_CATEGORIES = [
+    ("watched_shows", "sync/watched/shows", "episodes", "watched_at"),
+    ("watched_movies", "sync/watched/movies", "movies", "watched_at"),
+    ("rated_shows", "sync/ratings/shows", "shows", "rated_at"),
+    ("rated_movies", "sync/ratings/movies", "movies", "rated_at"),
+]
+
+# Library caches already loaded by this process (daemon cycles skip re-reading the file)
+_TRAKT_LIBRARY_IN_MEMORY = {}
+
+class TraktLibraryIndex:
+    """
+    One category of the Trakt library (e.g. rated shows): integer Trakt IDs in a sorted array, and for the
+    rated categories a parallel array with each item's current rating. Lookups are binary searches, so a
+    large library takes 8-9 bytes per item instead of a set of strings.
+    """
+    def __init__(self, items=(), rated=False):
+        """items: Trakt IDs, or (Trakt ID, rating) pairs when rated."""
+        self._build(dict(items) if rated else dict.fromkeys(items), rated)
+
+    def _build(self, ratings, rated):
+        self.ids = array('q', sorted(ratings))
+        self.ratings = array('b', (ratings[trakt_id] for trakt_id in self.ids)) if rated else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, trakt_id):
+        return self._position(trakt_id) is not None
+
+    def _position(self, trakt_id):
+        position = bisect.bisect_left(self.ids, int(trakt_id))
+        return position if position < len(self.ids) and self.ids[position] == int(trakt_id) else None
+
+    def get(self, trakt_id, default=None):
+        """Returns the current rating of a Trakt ID in a rated index, or default if it isn't rated."""
+        position = self._position(trakt_id)
+        return default if position is None or self.ratings is None else self.ratings[position]
+
+    def update(self, items):
+        """Adds Trakt IDs (or replaces (Trakt ID, rating) pairs), re-sorting once (for the items synced by a run)."""
+        rated = self.ratings is not None
+        ratings = dict(zip(self.ids, self.ratings)) if rated else dict.fromkeys(self.ids)
+        ratings.update(items if rated else dict.fromkeys(items))
+        self._build(ratings, rated)
+
+    def to_json(self):
+        return [self.ids.tolist()] + ([self.ratings.tolist()] if self.ratings is not None else [])
+
+    @classmethod
+    def from_json(cls, data):
+        """Rebuilds an index saved by to_json (already sorted)."""
+        index = cls()
+        index.ids = array('q', data[0])
+        index.ratings = array('b', data[1]) if len(data) > 1 else None
+        if index.ratings is not None and len(index.ids) != len(index.ratings):
+            raise ValueError("Trakt library index has mismatched ID and rating counts")
+        return index
+
+def _season_key(trakt_id, season):
+    """Packs a show's Trakt ID and a season number into one integer key of the watched seasons index."""
+    return (int(trakt_id) << 16) | int(season)
+
+def trakt_library_index(cache, kind, item_type):
+    """Returns the TraktLibraryIndex of 'watched' or 'rated' items of a type ('show' or 'movie')."""
+    return cache[f"{kind}_{item_type}s"]['index']
+
+def _trakt_library_from_json(data):
+    """Rebuilds the library cache from its file (categories missing from it are downloaded)."""
+    cache = {'refreshed_at': data.get('refreshed_at', 0)}
+    for category, _endpoint, _section, _field in TRAKT_LIBRARY_CATEGORIES:
+        saved = data.get(category)
+        if not saved: continue
+        cache[category] = {"activity": saved.get('activity'), "seasons": saved.get('seasons', False),
+                           "index": TraktLibraryIndex.from_json(saved['index']),
+                           "season_index": TraktLibraryIndex.from_json(saved['season_index']) if saved.get('season_index') else None}
+    return cache
+
+def load_trakt_library(trakt_client, cache_file, force_refresh=False):
+    """
+    Returns the library cache, refreshing only the categories Trakt reports activity for. Every category
+    holds a TraktLibraryIndex (see trakt_library_index), watched shows also a season_index when
+    FRANCHISE_SEASONS is on. Returns None if a refresh fails.
+    """
+    cache = {} if force_refresh else _TRAKT_LIBRARY_IN_MEMORY.get(cache_file, {})
+    if not cache and not force_refresh and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = _trakt_library_from_json(json.load(f))
+        except (json.JSONDecodeError, IOError, ValueError, TypeError, AttributeError, KeyError, OverflowError) as e:
+            print(f"Warning: Could not load Trakt library cache {cache_file}: {e}. Re-downloading.")
+            cache = {}
+    if time.time() - cache.get('refreshed_at', 0) > TRAKT_LIBRARY_MAX_AGE_DAYS * 86400:
+        cache = {'refreshed_at': time.time()} # Full refresh
+
+    activities = get_trakt_last_activities(trakt_client) or {}
+    refreshed = []
+    for category, endpoint, section, field in TRAKT_LIBRARY_CATEGORIES:
+        activity = activities.get(section, {}).get(field)
+        cached = cache.get(category)
+        with_seasons = FRANCHISE_SEASONS and category == "watched_shows"
+        if cached is not None and activity and cached.get('activity') == activity and cached.get('seasons', False) == with_seasons:
+            continue # No new activity on Trakt for this category
+        indexes = _get_trakt_sync_ids(endpoint, trakt_client, with_seasons)
+        if indexes is None: return None
+        cache[category] = {"activity": activity, "index": indexes[0], "season_index": indexes[1], "seasons": with_seasons}
+        refreshed.append(category)
+
+    if refreshed:
+        print(f"Refreshed Trakt library from Trakt: {', '.join(refreshed)}.")
+        save_trakt_library_cache(cache, cache_file)
+    else:
+        print("No new activity on Trakt since the last run, using cached Trakt library.")
+    _TRAKT_LIBRARY_IN_MEMORY[cache_file] = cache
+    print(f"Found {len(cache['watched_shows']['index']) + len(cache['watched_movies']['index'])} existing watched items on Trakt.")
+    print(f"Found {len(cache['rated_shows']['index']) + len(cache['rated_movies']['index'])} existing rated items on Trakt.")
+    return cache
+
+def save_trakt_library_cache(cache, cache_file):
+    """Saves the Trakt library cache file."""
+    data = {'refreshed_at': cache.get('refreshed_at', 0)}
+    for category, _endpoint, _section, _field in TRAKT_LIBRARY_CATEGORIES:
+        if category not in cache: continue
+        saved = cache[category]
+        data[category] = {"activity": saved['activity'], "seasons": saved['seasons'], "index": saved['index'].to_json(),
+                          "season_index": saved['season_index'].to_json() if saved.get('season_index') is not None else None}
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+    except IOError as e:
+        print(f"Error: Could not save Trakt library cache to {cache_file}: {e}")
+
+def record_trakt_library_additions(cache, cache_file, synced):
+    """
+    Adds the items synced by this run (TraktBatchWriter.synced) to the library cache. The categories keep the
+    activity timestamps fetched before the run: Trakt's current ones would also cover history or ratings another
+    client added meanwhile, so the next run re-downloads the categories this run changed.
+    """
+    kinds = {"watched": "history", "rated": "ratings"}
+    for category, _endpoint, _section, _field in TRAKT_LIBRARY_CATEGORIES:
+        kind, item_type = category.split('_')
+        added = [entry for entry in synced[kinds[kind]] if entry[0] == item_type[:-1]]
+        if not added: continue
+        if kind == "watched": cache[category]['index'].update(trakt_id for _type, trakt_id, _season, _rating in added)
+        else: cache[category]['index'].update((trakt_id, rating) for _type, trakt_id, _season, rating in added)
+        if cache[category].get('season_index') is not None:
+            cache[category]['season_index'].update(_season_key(trakt_id, season) for _type, trakt_id, season, _rating in added if season)
+    save_trakt_library_cache(cache, cache_file)
+
+def _batch_library_entries(kind, items):
+    """
+    Returns (item_type, trakt_id, season, rating) of the items in a history/ratings batch (rating None for history).
+    """
+    entries = []
+    for item in items:
+        if not (item.get('type') and item.get('trakt_ids', {}).get('trakt')): continue
+        rating = (item.get('rating') or 0) if kind == "ratings" else None
+        entries.append((item['type'], int(item['trakt_ids']['trakt']), item.get('season'), rating))
+    return entries
 
 
 # --- Stylish Print Function ---
@@ -720,175 +2289,378 @@ def print_boxed_attribution():
     print(" " * 4 + "└" + "─" * width + "┘")
 
 
-# --- Main Execution ---
-if __name__ == "__main__":
-    print(f"--- {DATA_SOURCE} to Trakt Migration Script ---")
+# --- Accounts ---
+# An account is a dict: name, data_source, username, mal_client_id, token_file, library_cache_file, journal_file
+# (plus trakt_limiters when several accounts are synced at once).
+
+def get_configured_account():
+    """Returns the single account set up in the configuration section."""
+    username = MAL_USERNAME if DATA_SOURCE == "MAL" else ANILIST_USERNAME
+    return {"name": username, "data_source": DATA_SOURCE, "username": username, "mal_client_id": MAL_CLIENT_ID,
+            "token_file": TRAKT_TOKEN_FILE,
+            "library_cache_file": _state_file_path(TRAKT_LIBRARY_CACHE_FILE, "trakt_library_cache.json"),
+            "journal_file": _state_file_path(None, "sync_journal.jsonl")}
+
+def load_accounts_file(accounts_file):
+    """
+    Loads the accounts to sync from a JSON file: a list (or {"accounts": [...]}) of objects with
+    data_source, username, trakt_token_file and optionally name, mal_client_id, library_cache_file and journal_file.
+    Returns a list of accounts, or None if the file is missing or invalid.
+    """
+    try:
+        with open(accounts_file, 'r') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Error: Could not load accounts file {accounts_file}: {e}")
+        return None
+    entries = data.get('accounts') if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        print(f"Error: Accounts file {accounts_file} must contain a non-empty list of accounts.")
+        return None
 
-    # --- Configuration Checks ---
-    if "YOUR_TRAKT_CLIENT_ID" in TRAKT_CLIENT_ID or "YOUR_TRAKT_CLIENT_SECRET" in TRAKT_CLIENT_SECRET:
-        print("Error: Please update TRAKT_CLIENT_ID and TRAKT_CLIENT_SECRET in the script configuration.")
-        exit(1)
+    accounts = []
+    for i, entry in enumerate(entries, 1):
+        data_source = entry.get('data_source')
+        username = entry.get('username')
+        token_file = entry.get('trakt_token_file')
+        if data_source not in ("MAL", "AniList") or not username or not token_file:
+            print(f"Error: Account #{i} in {accounts_file} needs data_source ('MAL' or 'AniList'), username and trakt_token_file.")
+            return None
+        mal_client_id = entry.get('mal_client_id') or MAL_CLIENT_ID
+        if data_source == "MAL" and (not mal_client_id or "YOUR_MAL_CLIENT_ID" in mal_client_id):
+            print(f"Error: Account #{i} in {accounts_file} uses MAL but no mal_client_id is set (here or in MAL_CLIENT_ID).")
+            return None
+        accounts.append({
+            "name": entry.get('name') or f"{data_source}:{username}", "data_source": data_source,
+            "username": username, "mal_client_id": mal_client_id, "token_file": token_file,
+            # Each Trakt user needs its own library cache; default to one next to the account's token file
+            "library_cache_file": entry.get('library_cache_file') or os.path.splitext(token_file)[0] + "_library_cache.json",
+            "journal_file": entry.get('journal_file') or os.path.splitext(token_file)[0] + "_journal.jsonl",
+        })
+
+    for key in ("name", "token_file", "library_cache_file", "journal_file"):
+        values = [account[key] for account in accounts]
+        if len(set(values)) != len(values):
+            print(f"Error: Accounts in {accounts_file} must not share a {key}.")
+            return None
+    return accounts
+
+def run_accounts_sync(args, accounts):
+    """
+    Syncs several accounts on ACCOUNT_WORKERS threads. The match cache, ID mapping and HTTP connection
+    pools are shared, so a title matched for one account is a cache hit for the others; each account
+    gets its own Trakt request budget. Returns the highest exit code of all accounts.
+    """
+    # Trakt device authentication may prompt, so do it one account at a time before syncing
+    for account in accounts:
+        print(f"\nChecking Trakt authentication for account '{account['name']}'...")
+        if not get_trakt_access_token(account['token_file']):
+            print(f"Error: Trakt authentication failed for account '{account['name']}'.")
+            return 1
+        if 'trakt_limiters' not in account: account['trakt_limiters'] = new_trakt_user_limiters()
+
+    # Build the shared caches once, not once per concurrent account
+    for shared_conn in (open_match_cache(), open_id_mapping_index()):
+        if shared_conn is not None: shared_conn.close()
+
+    workers = max(1, min(ACCOUNT_WORKERS, len(accounts)))
+    TRAKT_CLIENT.set_pool_size(workers * (SEARCH_WORKERS + 2))
+    ANILIST_CLIENT.set_pool_size(workers + 1)
+    MAL_CLIENT.set_pool_size(workers + 1)
+
+    exit_codes = {}
+    with ThreadPoolExecutor(max_workers=workers) as account_executor:
+        futures = {account_executor.submit(run_sync, args, account): account['name'] for account in accounts}
+        for future in futures:
+            try: exit_codes[futures[future]] = future.result()
+            except Exception as e:
+                print(f"Error: Sync for account '{futures[future]}' failed: {e}")
+                exit_codes[futures[future]] = 1
+
+    print("\n--- Accounts Summary ---")
+    for name, exit_code in exit_codes.items():
+        print(f"{name}: {'OK' if exit_code == 0 else 'FAILED (see logs above)'}")
+    return max(exit_codes.values())
+
+def run_daemon(args, accounts, sync_once):
+    """
+    Runs sync_once every DAEMON_INTERVAL_MINUTES (plus up to DAEMON_JITTER_SECONDS) in one long-lived process.
+    HTTP connections, match cache connections and the Trakt library stay in memory between cycles, and
+    incremental runs make most cycles a single source request. Cycles run one after another on this
+    thread, so they never overlap; a cycle that overruns the interval is followed by the next one right away.
+    """
+    interval = (args.interval or DAEMON_INTERVAL_MINUTES) * 60
+    print(f"Daemon mode: syncing every {interval / 60:g} minutes (+ up to {DAEMON_JITTER_SECONDS}s jitter). Press Ctrl+C to stop.")
+    cycle = 0
+    try:
+        while True:
+            cycle += 1
+            cycle_started = time.time()
+            print(f"\n=== Sync cycle {cycle} started at {datetime.datetime.now().isoformat(timespec='seconds')} ===")
+            try:
+                exit_code = sync_once()
+            except Exception as e:
+                print(f"Error: Sync cycle {cycle} failed: {e}")
+                exit_code = 1
+            args.full = args.resume = False # --full and --resume only apply to the first cycle
+
+            next_start = cycle_started + interval + random.uniform(0, DAEMON_JITTER_SECONDS)
+            # Refresh tokens now if they would expire before the next cycle, instead of at its start
+            for account in accounts:
+                get_trakt_access_token(account['token_file'], min_valid_seconds=max(86400, next_start - time.time() + 3600))
+            next_iso = datetime.datetime.fromtimestamp(next_start).isoformat(timespec='seconds')
+            print(f"=== Sync cycle {cycle} finished ({'OK' if exit_code == 0 else 'with errors'}). Next cycle at {next_iso}. ===")
+            time.sleep(max(0, next_start - time.time()))
+    except KeyboardInterrupt:
+        print("\nDaemon stopped.")
+    return 0
+
+
+# --- Source Entry Processing ---
+
+def is_syncable_completed_entry(entry, data_source):
+    """True for raw MAL/AniList entries that are completed and in a format the sync supports."""
+    if data_source == "MAL":
+        # Ensure entry has list_status and node, list status is 'completed', and media type is supported
+        return bool(entry.get('list_status') and entry.get('node') and
+                    entry['list_status'].get('status') == 'completed' and
+                    entry['node'].get('media_type') not in ['music', 'unknown']) # Exclude unsupported types
+    # AniList: ensure entry has status and media, status is COMPLETED, and type is ANIME
+    return bool(entry.get('status') and entry.get('media') and
+                entry['status'] == 'COMPLETED' and
+                entry['media'].get('type') == 'ANIME')
+
+def get_watching_progress(entry, data_source):
+    """Episodes watched so far for a raw CURRENT/watching entry (0 if none), or None for other entries."""
+    if data_source == "MAL":
+        list_status = entry.get('list_status') or {}
+        if list_status.get('status') != 'watching' or not entry.get('node'): return None
+        return list_status.get('num_episodes_watched') or 0
+    if entry.get('status') != 'CURRENT' or (entry.get('media') or {}).get('type') != 'ANIME': return None
+    return entry.get('progress') or 0
+
+# One list entry as the sync needs it, converted once when its page is fetched (the raw JSON is released then).
+# rating is the Trakt rating (1-10, None without a score), completed_at the ISO completion date (None if unknown),
+# alt_titles the native title and synonyms (for ranking Trakt search results), watching_progress the episodes
+# watched for CURRENT/watching entries (None for completed entries), episode_count the anime's episodes (None if unknown).
+SourceEntry = collections.namedtuple("SourceEntry", [
+    "source_id", "title_main", "title_english", "year", "media_format", "rating", "completed_at",
+    "display_title", "alt_titles", "watching_progress", "episode_count"], defaults=((), None, None))
+
+# A converted source page: the entries to sync, the newest 'updated' time on the page (for the watermark),
+# and how many entries could not be converted
+SourcePage = collections.namedtuple("SourcePage", ["entries", "newest_updated_at", "failed"])
+
+def to_source_entry(entry, data_source):
+    """Converts a raw MAL/AniList list entry into a SourceEntry."""
+    if data_source == "MAL":
+        node = entry.get('node', {})
+        source_list_status = entry.get('list_status', {})
+
+        source_id = node.get('id')
+        title_main = node.get('title')
+        alternative_titles = node.get('alternative_titles') or {}
+        title_english = alternative_titles.get('en')
+        alt_titles = tuple(filter(None, [alternative_titles.get('ja')] + list(alternative_titles.get('synonyms') or [])))
+        # Extract year from start_date string (can be YYYY-MM-DD, YYYY-MM, YYYY)
+        start_date_str = node.get('start_date')
+        year = int(start_date_str[:4]) if start_date_str and len(start_date_str) >= 4 else None
+        media_format = node.get('media_type')
+        episode_count = node.get('num_episodes') or None # 0 while unknown
+        rating = convert_mal_score_to_rating(source_list_status.get('score')) # MAL score: 0-10
+        completed_at = format_mal_date_to_iso(source_list_status.get('finish_date')) # 'YYYY-MM-DD' or ''
+
+    else: # AniList
+        media = entry.get('media', {})
+
+        source_id = media.get('id')
+        title_main = media.get('title', {}).get('romaji')
+        title_english = media.get('title', {}).get('english')
+        alt_titles = tuple(filter(None, [media.get('title', {}).get('native')] + list(media.get('synonyms') or [])))
+        year = media.get('startDate', {}).get('year')
+        media_format = media.get('format')
+        episode_count = media.get('episodes')
+        rating = convert_anilist_score_to_rating(entry.get('score')) # AniList score: 0-100
+        completed_at = format_anilist_date_to_iso(entry.get('completedAt')) # { year, month, day } dict
+
+    display_title = title_english or title_main or f"{data_source} ID: {source_id}"
+    return SourceEntry(source_id, title_main, title_english, year, media_format, rating, completed_at,
+                       display_title, alt_titles, get_watching_progress(entry, data_source), episode_count)
+
+def convert_source_page(page_entries, data_source):
+    """
+    Converts a raw source page into a SourcePage holding only the entries the sync handles: completed ones,
+    and watching ones with progress when SYNC_WATCHING_PROGRESS is on.
+    """
+    entries = []; newest_updated_at = None; failed = 0
+    for entry in page_entries:
+        entry_updated_at = get_source_entry_updated_at(entry)
+        if entry_updated_at and (newest_updated_at is None or entry_updated_at > newest_updated_at):
+            newest_updated_at = entry_updated_at
+        if not (is_syncable_completed_entry(entry, data_source) or
+                (SYNC_WATCHING_PROGRESS and get_watching_progress(entry, data_source))):
+            continue
+        try: # Add try-except block for safer data extraction
+            entries.append(to_source_entry(entry, data_source))
+        except Exception as e:
+            tqdm.write(f"Error extracting data for an entry: {e} - Entry data: {entry}")
+            failed += 1
+    return SourcePage(entries, newest_updated_at, failed)
 
-    if DATA_SOURCE == "MAL":
-        if "YOUR_MAL_CLIENT_ID" in MAL_CLIENT_ID:
-             print("Error: Please update MAL_CLIENT_ID in the script configuration.")
-             exit(1)
-        if not MAL_USERNAME or "YOUR_MAL_USERNAME" in MAL_USERNAME:
-             print("Error: Please update MAL_USERNAME in the script configuration.")
-             exit(1)
-    elif DATA_SOURCE == "AniList":
-        if not ANILIST_USERNAME or "YOUR_ANILIST_USERNAME" in ANILIST_USERNAME:
-             print("Error: Please update ANILIST_USERNAME in the script configuration.")
-             exit(1)
-    else:
-        print(f"Error: Invalid DATA_SOURCE selected: '{DATA_SOURCE}'. Choose 'MAL' or 'AniList'.")
-        exit(1)
+# Marks the end of the source page stream on the pipeline queue
+_SOURCE_DONE = object()
 
+def _put_page(page_queue, item, stop):
+    """Puts an item on the page queue, waiting while it is full. Returns False if the consumer stopped first."""
+    while not stop.is_set():
+        try:
+            page_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _feed_source_pages(pages, page_queue, data_source, stop):
+    """
+    Producer thread: converts each source page into a SourcePage as it arrives and puts it on the bounded
+    queue (None if a fetch failed), then _SOURCE_DONE. Returns early once `stop` is set.
+    """
+    try:
+        for page_entries in pages:
+            if page_entries is None: # Fetch failed
+                _put_page(page_queue, None, stop); break
+            # Blocks while the consumer is SOURCE_QUEUE_PAGES pages behind
+            if not _put_page(page_queue, convert_source_page(page_entries, data_source), stop): return
+    except Exception as e:
+        print(f"Error fetching {data_source} data: {e}")
+        _put_page(page_queue, None, stop)
+    finally:
+        _put_page(page_queue, _SOURCE_DONE, stop)
+
+
+# --- Main Execution ---
+def run_sync(args, account):
+    """Runs one sync from an account's source list to its Trakt profile. Returns the process exit code."""
+    data_source = account['data_source']
+    match_cache = account.get('match_cache') or open_match_cache()
+    if args.daemon: account['match_cache'] = match_cache # Kept open between daemon cycles
 
     # 1. Authenticate with Trakt (Always Required)
-    trakt_access_token = get_trakt_access_token()
+    trakt_access_token = get_trakt_access_token(account['token_file'])
     if not trakt_access_token:
-        print("Exiting due to Trakt authentication failure.")
-        exit(1)
+        print(f"[{account['name']}] Exiting due to Trakt authentication failure.")
+        if match_cache is not None and not args.daemon: match_cache.close()
+        return 1
+    # Bearer token is set once on the (pooled) Trakt client used for all calls below
+    trakt_client = get_trakt_user_client(trakt_access_token, account.get('trakt_limiters'))
 
     # 2. Notify User about Source API Access Method
-    if DATA_SOURCE == "MAL":
+    if data_source == "MAL":
         print("MAL Sync selected: Using public API access (no user authentication required).")
-    elif DATA_SOURCE == "AniList":
+    elif data_source == "AniList":
         print("AniList Sync selected: Using public API access.")
 
-    # 3. Fetch Existing Trakt Data (to avoid duplicates)
-    existing_watched_ids = get_trakt_watched_ids(trakt_access_token)
-    if existing_watched_ids is None:
-        print("Exiting due to failure fetching existing Trakt watched history.")
-        exit(1)
-    time.sleep(API_CALL_DELAY) # Delay before next Trakt API call
-
-    existing_rated_ids = get_trakt_rated_ids(trakt_access_token)
-    if existing_rated_ids is None:
-        print("Exiting due to failure fetching existing Trakt ratings.")
-        exit(1)
-    time.sleep(API_CALL_DELAY) # Delay before fetching from source
-
-    # 4. Fetch Source Data (MAL or AniList)
-    source_entries = None
-    print(f"\nFetching data from {DATA_SOURCE}...")
-    if DATA_SOURCE == "MAL":
-        source_entries = get_mal_anime_list(MAL_USERNAME, MAL_CLIENT_ID)
-    elif DATA_SOURCE == "AniList":
-        source_entries = get_anilist_data(ANILIST_USERNAME)
-
-    # Handle potential failure during source data fetch
-    if source_entries is None:
-        print(f"Exiting due to failure fetching {DATA_SOURCE} data. Check logs above for details (e.g., private list, wrong username, API errors).")
-        exit(1)
-    if not source_entries:
-         print(f"No anime entries found on {DATA_SOURCE} profile to process.")
-         exit(0)
-
-    # 5. Filter for Completed Anime (Primary target for sync)
-    completed_anime = []
-    if DATA_SOURCE == "MAL":
-        completed_anime = [
-            e for e in source_entries
-            # Ensure entry has list_status and node, list status is 'completed', and media type is supported
-            if e.get('list_status') and e.get('node') and
-               e['list_status'].get('status') == 'completed' and
-               e['node'].get('media_type') not in ['music', 'unknown'] # Exclude unsupported types
-        ]
-    elif DATA_SOURCE == "AniList":
-        completed_anime = [
-            e for e in source_entries
-            # Ensure entry has status and media, status is COMPLETED, and type is ANIME
-            if e.get('status') and e.get('media') and
-               e['status'] == 'COMPLETED' and
-               e['media'].get('type') == 'ANIME' # Ensure it's anime
-        ]
-
-    if not completed_anime:
-        print(f"No *completed* and syncable anime found on {DATA_SOURCE} profile to process.")
-        exit(0)
-
-    print(f"\nFound {len(completed_anime)} completed {DATA_SOURCE} anime to process for Trakt sync.")
-    print("Will skip items already marked as watched or rated on Trakt.")
+    # 3. Stream Source Data (MAL or AniList)
+    # Incremental runs only fetch entries updated after the watermark saved by the last successful run
+    sync_state = load_sync_state()
+    watermark_key = f"{data_source}:{account['username']}"
+    updated_since = None
+    if INCREMENTAL_SYNC and not args.full:
+        updated_since = sync_state.get('source_watermarks', {}).get(watermark_key)
+
+    # --resume continues an interrupted run: same watermark, entries it already finished are skipped
+    resumed = load_sync_journal(account['journal_file']) if args.resume else None
+    done_source_ids = set(); resumed_matches = {}
+    if resumed:
+        updated_since, done_source_ids, resumed_matches = resumed
+        print(f"Resuming the interrupted run: {len(done_source_ids)} entries were already handled.")
+    elif args.resume:
+        print("No interrupted run to resume, starting a normal sync.")
+    elif os.path.exists(account['journal_file']):
+        print("Note: The previous run was interrupted. Run with --resume to skip the entries it already handled.")
+
+    print(f"\n[{account['name']}] Fetching data from {data_source}...")
+    if updated_since is not None:
+        since_iso = datetime.datetime.fromtimestamp(updated_since, datetime.timezone.utc).isoformat(timespec='seconds')
+        print(f"Incremental sync: only fetching entries updated since {since_iso} (use --full to fetch everything).")
+    if data_source == "MAL":
+        source_pages = iter_mal_pages(account['username'], account['mal_client_id'], updated_since)
+    else:
+        source_pages = iter_anilist_entries(account['username'], updated_since)
+
+    # Read pages up to the first non-empty one here, so a run without source changes exits before touching Trakt
+    first_pages = []
+    for page_entries in source_pages:
+        first_pages.append(page_entries)
+        if page_entries is None or page_entries: break
+    if first_pages and first_pages[-1] is None:
+        print(f"Exiting due to failure fetching {data_source} data. Check logs above for details (e.g., private list, wrong username, API errors).")
+        if match_cache is not None and not args.daemon: match_cache.close()
+        return 1
+    # Unmatched entries due for another search; queued after the source list unless it contained them
+    retry_entries = load_due_trakt_misses(match_cache, data_source, account['username'])
+    if not any(first_pages) and not retry_entries:
+        if updated_since is not None: print(f"No changes on {data_source} since the last sync.")
+        else: print(f"No anime entries found on {data_source} profile to process.")
+        METRICS.record_account_run(account['name'], {})
+        if match_cache is not None and not args.daemon: match_cache.close()
+        return 0
+
+    # 4. Load Existing Trakt Data (to avoid duplicates) - cached, only re-downloaded on new Trakt activity
+    # Loaded before the producer starts: once it runs, the search loop below has to consume every page
+    print("\nChecking existing Trakt watched history and ratings...")
+    trakt_library_cache = load_trakt_library(trakt_client, account['library_cache_file'], force_refresh=args.full)
+    if trakt_library_cache is None:
+        print("Exiting due to failure fetching existing Trakt watched history or ratings.")
+        if match_cache is not None and not args.daemon: match_cache.close()
+        return 1
+    id_mapping = open_id_mapping_index()
+
+    # The remaining pages are fetched in the background while Trakt is searched (bounded queue)
+    page_queue = queue.Queue(maxsize=max(1, SOURCE_QUEUE_PAGES))
+    stop_producer = threading.Event()
+    producer = threading.Thread(target=_feed_source_pages, args=(itertools.chain(first_pages, source_pages), page_queue, data_source, stop_producer), daemon=True)
+    del first_pages
+
+    journal = SyncJournal(account['journal_file'], updated_since, resume=bool(resumed))
+
+    print("\nWill sync completed anime as they are fetched.")
+    print("Will skip items already marked as watched on Trakt" +
+          (" and re-rate items whose score changed." if UPDATE_CHANGED_RATINGS else " or rated on Trakt."))
     print("Will attempt to rate each Trakt show/movie ID only once per run.")
 
-    # 6. Initialize counters and batches for Trakt sync
-    trakt_history_batch = []
-    trakt_ratings_batch = []
+    # 5. Initialize counters and the Trakt writer (batches are posted in the background)
+    writer = TraktBatchWriter(trakt_client, journal)
     # Keep track of items rated *during this run* to avoid duplicate rating attempts within the run
     rated_trakt_ids_this_run = set()
-    # Statistics counters
-    skipped_not_found = 0
-    skipped_already_watched = 0
-    skipped_already_rated = 0
-    skipped_rated_this_run = 0
-    skipped_unsupported_format = 0
-    skipped_missing_data = 0
-    history_prepared_count = 0
-    ratings_prepared_count = 0
-    total_history_synced = 0 # Based on successful batches sent
-    total_ratings_synced = 0 # Based on successful batches sent
-    failed_history_batches = 0
-    failed_ratings_batches = 0
+    # Statistics counters: completed, skipped_not_found, skipped_already_watched, skipped_already_rated, ratings_changed,
+    # skipped_rated_this_run, skipped_unsupported_format, skipped_missing_data, skipped_resumed, resumed_matches, skipped_unmatched_backoff,
+    # unmatched_retried, match_cache_hits, matched_by_id, franchise_shared, watching, episodes_prepared, skipped_progress_synced,
+    # search_errors, history_prepared, history_completed_episodes, ratings_prepared, history_synced, ratings_synced (based on successful batches sent),
+    # failed_history_batches, failed_ratings_batches
+    stats = collections.Counter()
+    unmatched_titles = [] # Entries not found on Trakt (searched this run or still backing off), for the summary
+    search_error_titles = [] # Entries whose Trakt search failed (errors, not misses), for the summary
+    # Watermark for the next run (saved only once this run has synced successfully)
+    new_watermark = updated_since
     # Get current time once for potential fallbacks
     now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z')
 
-
-    print(f"\nSearching Trakt (using title/year), checking for duplicates, and preparing batches...")
-    # --- Main Processing Loop ---
-    for entry in tqdm(completed_anime, desc=f"Processing {DATA_SOURCE} Entries"):
-        # --- Extract Data based on Source ---
-        title_main = None; title_english = None; source_id = None; year = None
-        media_format = None; source_score = None; completed_at_source_format = None
-
-        try: # Add try-except block for safer data extraction
-            if DATA_SOURCE == "MAL":
-                node = entry.get('node', {})
-                source_list_status = entry.get('list_status', {})
-                # Basic validation moved to filter step, but double-check here if needed
-                # if not node or not source_list_status: skipped_missing_data +=1; continue
-
-                source_id = node.get('id')
-                title_main = node.get('title')
-                alt_titles = node.get('alternative_titles', {})
-                title_english = alt_titles.get('en') if alt_titles else None
-                # Extract year from start_date string (can be YYYY-MM-DD, YYYY-MM, YYYY)
-                start_date_str = node.get('start_date')
-                year = int(start_date_str[:4]) if start_date_str and len(start_date_str) >= 4 else None
-                media_format = node.get('media_type')
-                source_score = source_list_status.get('score') # MAL score: 0-10
-                completed_at_source_format = source_list_status.get('finish_date') # 'YYYY-MM-DD' or ''
-
-            elif DATA_SOURCE == "AniList":
-                media = entry.get('media', {})
-                # if not media: skipped_missing_data +=1; continue # Validation moved to filter
-                source_list_status = entry
-
-                source_id = media.get('id')
-                title_main = media.get('title', {}).get('romaji')
-                title_english = media.get('title', {}).get('english')
-                year = media.get('startDate', {}).get('year')
-                media_format = media.get('format')
-                source_score = source_list_status.get('score') # AniList score: 0-100
-                completed_at_source_format = source_list_status.get('completedAt') # { year, month, day } dict
-
-            # Check for essential data after extraction
-            display_title = title_english or title_main or f"{DATA_SOURCE} ID: {source_id}"
-            if not (title_main or title_english):
-                tqdm.write(f"Skipping {DATA_SOURCE} ID {source_id}: No title found.")
-                skipped_missing_data += 1; continue
-            if not media_format:
-                 tqdm.write(f"Skipping '{display_title}' (ID: {source_id}): Missing media format.")
-                 skipped_missing_data += 1; continue
-
-        except Exception as e:
-            tqdm.write(f"Error extracting data for an entry: {e} - Entry data: {entry}")
-            skipped_missing_data += 1
-            continue # Skip to next entry
-
-        # --- Search Trakt ---
-        trakt_match = search_trakt(title_main, title_english, source_id, year, media_format, trakt_access_token)
+    def handle_search_result(source_entry, trakt_match, future):
+        """Turns one entry's Trakt match into history/rating batch items (called in source order)."""
+        source_id, media_format, display_title = source_entry.source_id, source_entry.media_format, source_entry.display_title
+        if future is not None:
+            trakt_match, matched_by_id = future.result()
+            if trakt_match is TRAKT_SEARCH_FAILED:
+                # Not journaled or recorded as a miss, so --resume and the next run search it again
+                stats['search_errors'] += 1
+                search_error_titles.append(f"{display_title} ({data_source} ID {source_id})")
+                progress.update(1)
+                return
+            if matched_by_id: stats['matched_by_id'] += 1
+            if trakt_match: store_trakt_match(match_cache, data_source, source_id, media_format, trakt_match)
+        batch_items = [] # (kind, item) handed to the Trakt writer once the entry is journaled
 
         if trakt_match:
             trakt_ids = None; item_type = None; specific_trakt_id = None; item_data = None
@@ -905,120 +2677,416 @@ if __name__ == "__main__":
             if trakt_ids and item_type and trakt_ids.get('trakt'):
                 specific_trakt_id = trakt_ids['trakt']
                 trakt_composite_id = f"{item_type}_{specific_trakt_id}" # e.g., "show_123"
-
-                # --- History Processing ---
-                # Check against existing Trakt watched list
-                if trakt_composite_id in existing_watched_ids:
-                    skipped_already_watched += 1
+                # FRANCHISE_SEASONS: history is per season, so other seasons don't count as watched
+                franchise = entry_seasons.get(str(source_id))
+                season = franchise[1] if franchise and item_type == "show" else None
+
+                if source_entry.watching_progress is not None:
+                    # --- Watching Entry: history up to the list progress, no rating until completed ---
+                    episode_ids = missing_show_episodes(source_entry, trakt_match, source_entry.watching_progress, season)
+                    if episode_ids:
+                        history_episode_ids.update(episode_ids)
+                        batch_items.append(("history", {
+                            "type": item_type, "trakt_ids": trakt_ids, "source_id": source_id,
+                            "episodes": episode_ids, "watched_at": now_iso, "title": display_title
+                        }))
+                        stats['episodes_prepared'] += len(episode_ids)
+                    else: stats['skipped_progress_synced'] += 1
                 else:
-                    # Format completion date to ISO string
-                    watched_at = None
-                    if DATA_SOURCE == "MAL": watched_at = format_mal_date_to_iso(completed_at_source_format)
-                    elif DATA_SOURCE == "AniList": watched_at = format_anilist_date_to_iso(completed_at_source_format)
-
-                    # Add to history batch using completion date or fallback to current time
-                    trakt_history_batch.append({
-                        "type": item_type, "trakt_ids": trakt_ids,
-                        "watched_at": watched_at or now_iso,
-                        "title": display_title # Keep title for potential debugging
-                    })
-                    history_prepared_count += 1
-
-                # --- Rating Processing ---
-                # Convert source score to Trakt rating (1-10)
-                trakt_rating = None
-                if DATA_SOURCE == "MAL": trakt_rating = convert_mal_score_to_rating(source_score)
-                elif DATA_SOURCE == "AniList": trakt_rating = convert_anilist_score_to_rating(source_score)
-
-                # Add rating only if score was valid (> 0)
-                if trakt_rating is not None:
-                    # Check against existing Trakt ratings and ratings added this run
-                    if trakt_composite_id in existing_rated_ids:
-                        skipped_already_rated += 1
-                    elif trakt_composite_id in rated_trakt_ids_this_run:
-                        skipped_rated_this_run += 1
+                    # --- History Processing ---
+                    # Check against existing Trakt watched list
+                    on_trakt = watched_on_trakt(item_type, specific_trakt_id, season)
+                    missing_episodes = None
+                    if on_trakt and item_type == "show":
+                        # Trakt also lists partly watched shows and seasons (e.g. synced earlier as a watching entry),
+                        # so the episodes the entry covers (its season, or its first episode_count) that are still
+                        # missing are sent; without either the show counts as watched
+                        missing_episodes = missing_show_episodes(source_entry, trakt_match, None if season else source_entry.episode_count, season)
+                    if on_trakt and not missing_episodes:
+                        stats['skipped_already_watched'] += 1
                     else:
-                        # Format completion date (same as watched_at) for rated_at timestamp
-                        rated_at = None
-                        if DATA_SOURCE == "MAL": rated_at = format_mal_date_to_iso(completed_at_source_format)
-                        elif DATA_SOURCE == "AniList": rated_at = format_anilist_date_to_iso(completed_at_source_format)
-
-                        # Add to ratings batch using completion date or fallback to current time
-                        trakt_ratings_batch.append({
-                            "type": item_type, "trakt_ids": trakt_ids,
-                            "rating": trakt_rating,
-                            "rated_at": rated_at or now_iso, # Use same date logic as history
-                            "title": display_title # For debugging
-                        })
-                        ratings_prepared_count += 1
-                        # Mark this Trakt item as rated *in this run*
-                        rated_trakt_ids_this_run.add(trakt_composite_id)
+                        # Add to history batch using completion date or fallback to current time
+                        history_item = {
+                            "type": item_type, "trakt_ids": trakt_ids, "source_id": source_id, "season": season,
+                            "watched_at": source_entry.completed_at or now_iso,
+                            "title": display_title # Keep title for potential debugging
+                        }
+                        if missing_episodes:
+                            history_item["episodes"] = missing_episodes
+                            history_episode_ids.update(missing_episodes)
+                            stats['history_completed_episodes'] += 1
+                        batch_items.append(("history", history_item))
+                        stats['history_prepared'] += 1
+
+                    # --- Rating Processing ---
+                    # Add rating only if score was valid (> 0)
+                    trakt_rating = source_entry.rating
+                    if trakt_rating is not None:
+                        # Check against existing Trakt ratings (re-rating changed scores) and ratings added this run
+                        current_rating = trakt_library_index(trakt_library_cache, "rated", item_type).get(specific_trakt_id)
+                        if current_rating is not None and (current_rating == trakt_rating or not UPDATE_CHANGED_RATINGS):
+                            stats['skipped_already_rated'] += 1
+                            # Other entries of the same item this run (e.g. franchise seasons) don't re-rate it either
+                            rated_trakt_ids_this_run.add(trakt_composite_id)
+                        elif trakt_composite_id in rated_trakt_ids_this_run:
+                            stats['skipped_rated_this_run'] += 1
+                        else:
+                            # Add to ratings batch using completion date or fallback to current time
+                            batch_items.append(("ratings", {
+                                "type": item_type, "trakt_ids": trakt_ids, "source_id": source_id,
+                                "rating": trakt_rating,
+                                "rated_at": source_entry.completed_at or now_iso, # Use same date logic as history
+                                "title": display_title # For debugging
+                            }))
+                            stats['ratings_prepared'] += 1
+                            if current_rating is not None: stats['ratings_changed'] += 1
+                            # Mark this Trakt item as rated *in this run*
+                            rated_trakt_ids_this_run.add(trakt_composite_id)
 
             else: # Trakt search result was missing required ID data
                  tqdm.write(f"Skipping '{display_title}' (ID: {source_id}): Could not extract valid Trakt IDs from search result: {trakt_match}")
-                 skipped_not_found += 1
+                 stats['skipped_not_found'] += 1
         # Handle cases where Trakt search returned None
         elif media_format in ['music', 'unknown']: # Check if format was skipped intentionally
-             skipped_unsupported_format += 1
+             stats['skipped_unsupported_format'] += 1
         else: # Genuine "not found" on Trakt search
-             skipped_not_found += 1
-
-
-        # --- Batch Sending Logic (Inside Loop) ---
-        # Send history batch if full
-        if len(trakt_history_batch) >= BATCH_SIZE:
-            tqdm.write(f"\nAdding HISTORY batch ({len(trakt_history_batch)} items)...")
-            success, count_synced = add_to_trakt_history(trakt_history_batch, trakt_access_token)
-            if success: total_history_synced += count_synced
-            else: failed_history_batches += 1
-            trakt_history_batch = [] # Clear batch
-            time.sleep(API_CALL_DELAY) # Delay after Trakt API call
-
-        # Send ratings batch if full
-        if len(trakt_ratings_batch) >= BATCH_SIZE:
-            tqdm.write(f"\nAdding RATINGS batch ({len(trakt_ratings_batch)} items)...")
-            success, count_synced = add_to_trakt_ratings(trakt_ratings_batch, trakt_access_token)
-            if success: total_ratings_synced += count_synced
-            else: failed_ratings_batches += 1
-            trakt_ratings_batch = [] # Clear batch
-            time.sleep(API_CALL_DELAY) # Delay after Trakt API call
-
-    # --- Send Final Batches (After Loop) ---
-    if trakt_history_batch:
-        tqdm.write(f"\nAdding final HISTORY batch ({len(trakt_history_batch)} items)...")
-        success, count_synced = add_to_trakt_history(trakt_history_batch, trakt_access_token)
-        if success: total_history_synced += count_synced
-        else: failed_history_batches += 1
-        # Delay if ratings batch follows
-        if trakt_ratings_batch: time.sleep(API_CALL_DELAY)
-
-    if trakt_ratings_batch:
-        tqdm.write(f"\nAdding final RATINGS batch ({len(trakt_ratings_batch)} items)...")
-        success, count_synced = add_to_trakt_ratings(trakt_ratings_batch, trakt_access_token)
-        if success: total_ratings_synced += count_synced
-        else: failed_ratings_batches += 1
+             stats['skipped_not_found'] += 1
+             unmatched_titles.append(f"{display_title} ({data_source} ID {source_id})")
+             record_trakt_miss(match_cache, data_source, account['username'], source_entry)
+
+        # Journal the entry before queueing its items, so the writer's batch records always follow it
+        journal.record_entry(source_id, [kind for kind, _ in batch_items], trakt_match)
+        for kind, item in batch_items: writer.add(kind, item)
+        progress.update(1)
+
+    show_progress = {} # Trakt show ID -> future with its season layout and watched episodes (one lookup per run)
+    show_progress_lock = threading.Lock() # Lookups are also started from search worker callbacks
+    history_episode_ids = set() # Episode Trakt IDs added to history this run, so other entries of a show don't repeat them
+
+    def watched_on_trakt(item_type, trakt_id, season):
+        """Whether Trakt lists the item as watched (for a FRANCHISE_SEASONS season: that season)."""
+        if trakt_id not in trakt_library_index(trakt_library_cache, "watched", item_type): return False
+        # Other seasons of the show may be watched while this one isn't
+        return not season or _season_key(trakt_id, season) in trakt_library_cache['watched_shows']['season_index']
+
+    def show_progress_lookup(source_entry, trakt_match):
+        """
+        Returns the future with the Trakt progress of the entry's show, submitting the lookup to the search workers
+        unless another entry of the show did, or None if the entry needs none: watching entries always compare
+        episodes, completed ones only if the show is watched and their season or episode count is known.
+        """
+        show = trakt_match.get('show') if isinstance(trakt_match, dict) else None
+        trakt_id = (show or {}).get('ids', {}).get('trakt')
+        if not trakt_id: return None
+        if source_entry.watching_progress is None:
+            franchise = entry_seasons.get(str(source_entry.source_id))
+            season = franchise[1] if franchise else None
+            if not (season or source_entry.episode_count) or not watched_on_trakt("show", trakt_id, season): return None
+        with show_progress_lock:
+            future = show_progress.get(trakt_id)
+            if future is None:
+                try: future = search_executor.submit(get_trakt_show_progress, match_cache, trakt_client, trakt_id)
+                except RuntimeError: return None # Workers already shut down (the loop ended on an error)
+                show_progress[trakt_id] = future
+        return future
+
+    def prefetch_show_progress(source_entry, future):
+        """Search future callback: starts the show progress lookup as soon as the entry's match is known."""
+        if not future.cancelled() and future.exception() is None:
+            show_progress_lookup(source_entry, future.result()[0])
+
+    def missing_show_episodes(source_entry, trakt_match, count, season):
+        """
+        Returns the Trakt IDs of the first `count` episodes (all if None) of the season, or of the regular seasons,
+        that neither Trakt nor this run has as watched. None if the show's progress is not available.
+        """
+        future = show_progress_lookup(source_entry, trakt_match)
+        show = future.result() if future is not None else None
+        if show is None: return None
+        seasons, watched = show
+        return [episode_id for season_number, number, episode_id in select_progress_episodes(seasons, count, season)
+                if (season_number, number) not in watched and episode_id not in history_episode_ids]
+
+    franchise_relations = {} # AniList relations of this run's entries and their prequels (FRANCHISE_SEASONS)
+    entry_seasons = {} # Source ID -> (franchise root ID, season number, root year)
+    franchise_matches = {} # Franchise root ID -> future with the franchise's Trakt match
+
+    def prepare_franchises(source_entries):
+        """Finds the franchise season of a page of entries (relations from the cache, the rest in bulk from AniList)."""
+        if not FRANCHISE_SEASONS or not source_entries: return
+        load_franchise_relations(match_cache, data_source, [e.source_id for e in source_entries], franchise_relations)
+        for source_entry in source_entries:
+            franchise = get_franchise_season(franchise_relations, source_entry.source_id)
+            if franchise: entry_seasons[str(source_entry.source_id)] = franchise
+
+    def submit_entry(source_entry):
+        """
+        Queues one entry for batching: the match journaled by the interrupted run (--resume) or the match cache
+        first, then the match of its franchise (FRANCHISE_SEASONS), known unmatched entries skipped, Trakt search otherwise.
+        """
+        source_id, media_format, year = source_entry.source_id, source_entry.media_format, source_entry.year
+        franchise = entry_seasons.get(str(source_id))
+        cached_match = resumed_matches.get(str(source_id))
+        if cached_match: stats['resumed_matches'] += 1
+        else:
+            cached_match = get_cached_trakt_match(match_cache, data_source, source_id, media_format)
+            if cached_match: stats['match_cache_hits'] += 1
+        if cached_match:
+            pending.append((source_entry, cached_match, None))
+            show_progress_lookup(source_entry, cached_match)
+            if franchise and franchise[0] not in franchise_matches and cached_match.get('type') == 'show':
+                franchise_matches[franchise[0]] = Future() # Later seasons reuse this match
+                franchise_matches[franchise[0]].set_result((cached_match, False))
+        elif franchise and franchise[0] in franchise_matches:
+            stats['franchise_shared'] += 1
+            pending.append((source_entry, None, franchise_matches[franchise[0]]))
+            franchise_matches[franchise[0]].add_done_callback(lambda future, entry=source_entry: prefetch_show_progress(entry, future))
+        elif get_trakt_miss_retry_at(match_cache, data_source, account['username'], source_id):
+            stats['skipped_unmatched_backoff'] += 1
+            unmatched_titles.append(f"{source_entry.display_title} ({data_source} ID {source_id})")
+        else:
+            mapped_ids = lookup_mapped_ids(id_mapping, data_source, source_id)
+            if franchise and franchise[2]: year = franchise[2] # Trakt lists the show under its first season's year
+            future = search_executor.submit(find_trakt_match, source_entry.title_main, source_entry.title_english, source_id, year,
+                                            media_format, trakt_client, mapped_ids, source_entry.alt_titles, search_cache)
+            pending.append((source_entry, None, future))
+            future.add_done_callback(lambda future, entry=source_entry: prefetch_show_progress(entry, future))
+            if franchise: franchise_matches[franchise[0]] = future
+
+    seen_source_ids = set() # Fetched this run; due unmatched entries among them are not queued twice
+
+    print(f"\nSearching Trakt (using title/year), checking for duplicates, and preparing batches...")
+    # --- Main Processing Loop ---
+    # Pages are consumed as the producer thread delivers them. Match cache lookups stay on this thread;
+    # misses are searched by a worker pool sharing the Trakt GET budget. Results are handed to the
+    # batching step strictly in source order, so batches and summary counters are deterministic.
+    search_executor = ThreadPoolExecutor(max_workers=max(1, SEARCH_WORKERS))
+    search_cache = SearchResponseCache() # Entries with the same search query share one Trakt request
+    pending = collections.deque() # (SourceEntry, cached match, search future) in source order
+    progress = tqdm(desc=f"Processing {data_source} Entries ({account['name']})", unit=" entries")
+    source_failed = False
+    producer.start()
+    # The producer and writer threads are stopped and joined however the loop ends (daemon mode runs it again)
+    try:
+        while True:
+            page = page_queue.get()
+            if page is _SOURCE_DONE:
+                retry_entries = [e for e in retry_entries if str(e.source_id) not in seen_source_ids and str(e.source_id) not in done_source_ids]
+                prepare_franchises(retry_entries)
+                for source_entry in retry_entries:
+                    stats['unmatched_retried'] += 1
+                    submit_entry(source_entry)
+                retry_entries = []
+                break
+            if page is None: source_failed = True; continue
+
+            if page.newest_updated_at and (new_watermark is None or page.newest_updated_at > new_watermark):
+                new_watermark = page.newest_updated_at
+            stats['skipped_missing_data'] += page.failed
+            page_entries = [] # Entries to look up on Trakt, after their franchise seasons are known
+            for source_entry in page.entries:
+                # Completed anime are synced in full, watching anime up to their progress (SYNC_WATCHING_PROGRESS)
+                stats['completed' if source_entry.watching_progress is None else 'watching'] += 1
+                source_id = source_entry.source_id
+                seen_source_ids.add(str(source_id))
+                if str(source_id) in done_source_ids:
+                    stats['skipped_resumed'] += 1; continue
+                # Check for essential data after extraction
+                if not (source_entry.title_main or source_entry.title_english):
+                    tqdm.write(f"Skipping {data_source} ID {source_id}: No title found.")
+                    stats['skipped_missing_data'] += 1; continue
+                if not source_entry.media_format:
+                     tqdm.write(f"Skipping '{source_entry.display_title}' (ID: {source_id}): Missing media format.")
+                     stats['skipped_missing_data'] += 1; continue
+                page_entries.append(source_entry)
+            del page
+
+            # --- Search Trakt (match cache first) ---
+            prepare_franchises(page_entries)
+            for source_entry in page_entries: submit_entry(source_entry)
+            del page_entries
+
+            # Batch every result that is ready; block on the oldest one while too much work is in flight
+            while pending and (pending[0][2] is None or pending[0][2].done() or len(pending) > SEARCH_QUEUE_SIZE):
+                handle_search_result(*pending.popleft())
+
+        while pending:
+            handle_search_result(*pending.popleft())
+    finally:
+        progress.close()
+        stop_producer.set()
+        producer.join()
+        for _, _, future in pending: # Left over only if the loop failed
+            if future is not None: future.cancel()
+        search_executor.shutdown()
+        # Send the final batches and wait for the batches still in flight
+        writer.close()
+    stats.update(writer.stats)
+
+    if stats['completed'] == 0 and stats['watching'] == 0 and stats['unmatched_retried'] == 0 and not source_failed:
+        print(f"No *completed* and syncable anime found on {data_source} profile to process.")
+        METRICS.record_account_run(account['name'], stats)
+        journal.close(finished=True)
+        save_source_watermark(sync_state, watermark_key, new_watermark)
+        if match_cache is not None and not args.daemon: match_cache.close()
+        if id_mapping is not None: id_mapping.close()
+        return 0
 
     # --- Final Summary ---
-    print(f"\n--- {DATA_SOURCE} to Trakt Migration Summary ---")
-    print(f"Processed {len(completed_anime)} completed {DATA_SOURCE} anime entries.")
-    print(f"Skipped {skipped_not_found} entries (not found on Trakt via title/year search).")
-    print(f"Skipped {skipped_already_watched} entries (already in Trakt watched history).")
-    print(f"Skipped {skipped_already_rated} entries (already rated on Trakt before this run).")
-    print(f"Skipped {skipped_rated_this_run} ratings (item already rated earlier in this run).")
-    print(f"Skipped {skipped_unsupported_format} entries (unsupported media format like 'music').")
-    print(f"Skipped {skipped_missing_data} entries (missing essential source data like title/format).")
+    print(f"\n--- {data_source} to Trakt Migration Summary ({account['name']}) ---")
+    print(f"Processed {stats['completed']} completed {data_source} anime entries.")
+    if SYNC_WATCHING_PROGRESS:
+        print(f"Processed {stats['watching']} watching {data_source} anime entries (synced up to their episode progress).")
+    print(f"Resolved {stats['match_cache_hits']} entries from the local match cache (no Trakt search needed).")
+    if resumed:
+        print(f"Skipped {stats['skipped_resumed']} entries already handled by the interrupted run (--resume).")
+        print(f"Reused {stats['resumed_matches']} Trakt matches journaled by the interrupted run (no lookup needed).")
+    if id_mapping is not None:
+        print(f"Resolved {stats['matched_by_id']} entries by exact ID from the offline ID mapping.")
+    if FRANCHISE_SEASONS:
+        print(f"Resolved {stats['franchise_shared']} sequel seasons from their franchise's Trakt match (no search needed).")
+    if search_cache.shared:
+        print(f"Shared {search_cache.shared} Trakt search responses between entries with the same query (sequels, variants).")
+    print(f"Skipped {stats['skipped_not_found']} entries (not found on Trakt via title/year search).")
+    if stats['search_errors']:
+        print(f"!!! WARNING: Skipped {stats['search_errors']} entries because the Trakt search failed (timeouts, server errors). They are searched again next run.")
+    if stats['unmatched_retried']:
+        print(f"Searched {stats['unmatched_retried']} previously unmatched entries again (retry time reached).")
+    if stats['skipped_unmatched_backoff']:
+        print(f"Skipped {stats['skipped_unmatched_backoff']} entries not found on Trakt by an earlier run (searched again later).")
+    print(f"Skipped {stats['skipped_already_watched']} entries (already in Trakt watched history).")
+    print(f"Skipped {stats['skipped_already_rated']} entries (already rated on Trakt before this run" +
+          (" with the same score)." if UPDATE_CHANGED_RATINGS else ")."))
+    print(f"Skipped {stats['skipped_rated_this_run']} ratings (item already rated earlier in this run).")
+    print(f"Skipped {stats['skipped_unsupported_format']} entries (unsupported media format like 'music').")
+    print(f"Skipped {stats['skipped_missing_data']} entries (missing essential source data like title/format).")
     print("-" * 25)
-    print(f"History Sync: Prepared {history_prepared_count} new entries.")
-    print(f"              Successfully synced approx {total_history_synced} history entries to Trakt.")
-    if failed_history_batches > 0:
-         print(f"!!! WARNING: {failed_history_batches} HISTORY batches failed or partially failed. Check logs above.")
+    print(f"History Sync: Prepared {stats['history_prepared']} new entries.")
+    if stats['history_completed_episodes']:
+        print(f"              {stats['history_completed_episodes']} of them complete partly watched shows (only the missing episodes are sent).")
+    if SYNC_WATCHING_PROGRESS:
+        print(f"              Prepared {stats['episodes_prepared']} episodes of watching entries "
+              f"({stats['skipped_progress_synced']} watching entries already up to date on Trakt).")
+    print(f"              Successfully synced approx {stats['history_synced']} history entries to Trakt.")
+    if stats['failed_history_batches'] > 0:
+         print(f"!!! WARNING: {stats['failed_history_batches']} HISTORY batches failed or partially failed. Check logs above.")
     print("-" * 25)
-    print(f"Ratings Sync: Prepared {ratings_prepared_count} new entries (score > 0, not rated before).")
-    print(f"              Successfully synced approx {total_ratings_synced} rating entries to Trakt.")
-    if failed_ratings_batches > 0:
-         print(f"!!! WARNING: {failed_ratings_batches} RATINGS batches failed or partially failed. Check logs above.")
+    print(f"Ratings Sync: Prepared {stats['ratings_prepared']} new entries (score > 0, not rated before).")
+    if stats['ratings_changed']:
+        print(f"Ratings Sync: {stats['ratings_changed']} of them re-rate items whose score changed since the Trakt rating.")
+    print(f"              Successfully synced approx {stats['ratings_synced']} rating entries to Trakt.")
+    if stats['failed_ratings_batches'] > 0:
+         print(f"!!! WARNING: {stats['failed_ratings_batches']} RATINGS batches failed or partially failed. Check logs above.")
+    if source_failed:
+         print(f"!!! WARNING: Fetching the {data_source} list failed partway. Only the entries fetched before the error were synced.")
+    if unmatched_titles:
+        print("-" * 25)
+        print(f"Unmatched titles ({len(unmatched_titles)}), use --override-match to pin them to a Trakt ID:")
+        for title in unmatched_titles[:UNMATCHED_TITLES_SHOWN]: print(f"  - {title}")
+        if len(unmatched_titles) > UNMATCHED_TITLES_SHOWN:
+            print(f"  ... and {len(unmatched_titles) - UNMATCHED_TITLES_SHOWN} more.")
+    if search_error_titles:
+        print("-" * 25)
+        print(f"Titles whose Trakt search failed ({len(search_error_titles)}), retried next run:")
+        for title in search_error_titles[:UNMATCHED_TITLES_SHOWN]: print(f"  - {title}")
+        if len(search_error_titles) > UNMATCHED_TITLES_SHOWN:
+            print(f"  ... and {len(search_error_titles) - UNMATCHED_TITLES_SHOWN} more.")
     print("-----------------------------")
     print("Migration complete.")
+    METRICS.record_account_run(account['name'], stats)
+
+    # Advance the source watermark only if every entry was searched and every batch reached Trakt,
+    # so entries with failed searches or batches are fetched again
+    run_succeeded = (stats['failed_history_batches'] == 0 and stats['failed_ratings_batches'] == 0 and
+                     stats['search_errors'] == 0 and not source_failed)
+    journal.close(finished=run_succeeded) # Kept after failures, so --resume only redoes the unfinished entries
+    if run_succeeded:
+        save_source_watermark(sync_state, watermark_key, new_watermark)
+        if writer.synced['history'] or writer.synced['ratings']:
+            record_trakt_library_additions(trakt_library_cache, account['library_cache_file'], writer.synced)
+    else:
+        print("Source watermark not advanced because some Trakt searches or batches failed; the next run will retry those entries.")
+
+    if match_cache is not None and not args.daemon: match_cache.close()
+    if id_mapping is not None: id_mapping.close()
+    return 1 if source_failed or stats['search_errors'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync completed anime history and ratings from MAL/AniList to Trakt.")
+    parser.add_argument("--invalidate-match", metavar="SOURCE_ID", action="append", default=[],
+                        help="Forget the cached Trakt match for a source ID (repeatable), then exit.")
+    parser.add_argument("--override-match", metavar=("SOURCE_ID", "TYPE", "TRAKT_ID"), nargs=3, action="append", default=[],
+                        help="Pin a source ID to a Trakt 'show' or 'movie' ID (repeatable), then exit.")
+    parser.add_argument("--full", action="store_true",
+                        help="Fetch the whole source list instead of only entries updated since the last run.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run, skipping the entries it already synced.")
+    parser.add_argument("--accounts", metavar="FILE",
+                        help="Sync every account listed in this JSON file (overrides ACCOUNTS_FILE).")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and sync on an interval instead of exiting after one sync.")
+    parser.add_argument("--interval", metavar="MINUTES", type=float,
+                        help=f"Minutes between daemon sync cycles (default DAEMON_INTERVAL_MINUTES = {DAEMON_INTERVAL_MINUTES}).")
+    args = parser.parse_args()
+
+    accounts_file = args.accounts or ACCOUNTS_FILE
+    print(f"--- {'Multi-Account' if accounts_file else DATA_SOURCE} to Trakt Migration Script ---")
+
+    # --- Configuration Checks ---
+    if "YOUR_TRAKT_CLIENT_ID" in TRAKT_CLIENT_ID or "YOUR_TRAKT_CLIENT_SECRET" in TRAKT_CLIENT_SECRET:
+        print("Error: Please update TRAKT_CLIENT_ID and TRAKT_CLIENT_SECRET in the script configuration.")
+        exit(1)
+
+    if accounts_file and not (args.invalidate_match or args.override_match):
+        accounts = load_accounts_file(accounts_file)
+        if accounts is None: exit(1)
+        print(f"Syncing {len(accounts)} accounts from {accounts_file} ({min(ACCOUNT_WORKERS, len(accounts))} at a time).")
+        sync_once = lambda: run_with_metrics(lambda: run_accounts_sync(args, accounts))
+        exit_code = run_daemon(args, accounts, sync_once) if args.daemon else sync_once()
+        print_boxed_attribution()
+        exit(exit_code)
+
+    if DATA_SOURCE == "MAL":
+        if "YOUR_MAL_CLIENT_ID" in MAL_CLIENT_ID:
+             print("Error: Please update MAL_CLIENT_ID in the script configuration.")
+             exit(1)
+        if not MAL_USERNAME or "YOUR_MAL_USERNAME" in MAL_USERNAME:
+             print("Error: Please update MAL_USERNAME in the script configuration.")
+             exit(1)
+    elif DATA_SOURCE == "AniList":
+        if not ANILIST_USERNAME or "YOUR_ANILIST_USERNAME" in ANILIST_USERNAME:
+             print("Error: Please update ANILIST_USERNAME in the script configuration.")
+             exit(1)
+    else:
+        print(f"Error: Invalid DATA_SOURCE selected: '{DATA_SOURCE}'. Choose 'MAL' or 'AniList'.")
+        exit(1)
+
+    # --- Match Cache Maintenance (no sync) ---
+    if args.invalidate_match or args.override_match:
+        match_cache = open_match_cache()
+        if match_cache is None:
+            print("Error: Match cache is unavailable.")
+            exit(1)
+        for source_id in args.invalidate_match:
+            removed = invalidate_trakt_match(match_cache, DATA_SOURCE, source_id)
+            print(f"Removed {removed} cached match(es) for {DATA_SOURCE} ID {source_id}.")
+        for source_id, trakt_type, trakt_id in args.override_match:
+            try:
+                if override_trakt_match(match_cache, DATA_SOURCE, source_id, trakt_type.lower(), trakt_id):
+                    print(f"{DATA_SOURCE} ID {source_id} now maps to Trakt {trakt_type.lower()} {trakt_id}.")
+            except ValueError:
+                print(f"Error: Invalid Trakt ID '{trakt_id}' for {DATA_SOURCE} ID {source_id}.")
+        exit(0)
+
+    account = get_configured_account()
+    sync_once = lambda: run_with_metrics(lambda: run_sync(args, account))
+    exit_code = run_daemon(args, [account], sync_once) if args.daemon else sync_once()
 
     # --- Attribution ---
     print_boxed_attribution()
+    exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
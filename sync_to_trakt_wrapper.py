@@ -0,0 +1,36 @@
+"""
+Docker entry point for sync_to_trakt.py.
+
+Takes the configuration from environment variables (see docker-compose.yml) instead of the configuration
+section of the script, keeps the Trakt tokens and every state file in CONFIG_DIR (the /config volume), then
+runs the script's main() with this process's command line, so e.g. `--daemon --interval 60` work as they do
+for sync_to_trakt.py itself.
+
+Environment: TRAKT_CLIENT_ID, TRAKT_CLIENT_SECRET, DATA_SOURCE ('MAL' or 'AniList'), MAL_CLIENT_ID,
+MAL_USERNAME, ANILIST_USERNAME, CONFIG_DIR (default /config). Unset variables keep the script's values.
+"""
+import os
+
+import sync_to_trakt as sync
+
+# Environment variable -> configuration global of sync_to_trakt.py
+ENV_SETTINGS = ["TRAKT_CLIENT_ID", "TRAKT_CLIENT_SECRET", "DATA_SOURCE", "MAL_CLIENT_ID", "MAL_USERNAME", "ANILIST_USERNAME"]
+
+
+def apply_environment():
+    """Copies the environment variables that are set into the script's configuration."""
+    for name in ENV_SETTINGS:
+        value = os.environ.get(name, "").strip()
+        if value: setattr(sync, name, value)
+    # The Trakt API key header is built at import time
+    sync.TRAKT_HEADERS["trakt-api-key"] = sync.TRAKT_CLIENT_ID
+    sync.TRAKT_CLIENT.headers["trakt-api-key"] = sync.TRAKT_CLIENT_ID
+    # Tokens and state files (match cache, library cache, watermarks, metrics, ...) live next to the token file
+    config_dir = os.environ.get("CONFIG_DIR", "/config")
+    os.makedirs(config_dir, exist_ok=True)
+    sync.TRAKT_TOKEN_FILE = os.path.join(config_dir, "trakt_tokens.json")
+
+
+if __name__ == "__main__":
+    apply_environment()
+    sync.main() # Parses sys.argv (--daemon, --interval, --full, ...) and exits with the sync's exit code